@@ -1,20 +1,41 @@
 import io
 import os
+import sys
+import signal
 import csv
+import json
+import functools
 import yaml
+import click
 import math
+import time
 import locale
+import random
+import sqlite3
+import zipfile
+import shutil
 import hashlib
 import requests
+import tempfile
+import threading
 import cryptography
-from flask import Flask, render_template, request, redirect, url_for, session, make_response, Response, g
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, session, make_response, Response, g, jsonify, \
+    send_file
 from fpdf import FPDF
+from fpdf.ttfonts import TTFontFile
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-from requests_oauthlib import OAuth1Session
-from oauth_wiki import get_username
+from flask_sqlalchemy.record_queries import get_recorded_queries
+from datetime import datetime, timedelta
+from oauth_wiki import get_username, resolve_username, forget_username, oauth_session, pooled_adapter
+from file_cache import FileCache
+from profiling import Metrics, span, record, server_timing
+from sqlalchemy.exc import OperationalError, IntegrityError
 from sqlalchemy_utils import StringEncryptedType
 from PyPDF2 import PdfFileReader, PdfFileWriter
+from urllib.parse import urlencode
 
 from email.message import EmailMessage
 import ssl
@@ -29,25 +50,332 @@ app.config['JSON_AS_ASCII'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
 app.config['SQLALCHEMY_BINDS'] = {'activities': 'sqlite:///users.db'}
 app.config.update(yaml.safe_load(open(os.path.join(__dir__, 'config.yaml'))))
+# Any key can also be set by an environment variable prefixed by FLASK_, e.g. FLASK_SQLALCHEMY_DATABASE_URI
+app.config.from_prefixed_env()
+# In debug mode the SQL statements of each request are counted against SQL_STATEMENTS_PER_ROUTE
+app.config.setdefault('SQLALCHEMY_RECORD_QUERIES', app.debug)
 
 # Initialize the database
 db = SQLAlchemy(app)
 
+# Readers don't block the writer in WAL mode, and writers wait up to busy_timeout milliseconds
+# for each other instead of failing with "database is locked". Replaced by SQLITE_PRAGMAS
+SQLITE_PRAGMAS = {'journal_mode': 'WAL',
+                  'busy_timeout': 5000,
+                  'synchronous': 'NORMAL',
+                  'mmap_size': 256 * 1024 * 1024}
+
+
+@db.event.listens_for(db.Engine, 'connect')
+def tune_sqlite(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in app.config.get('SQLITE_PRAGMAS', SQLITE_PRAGMAS).items():
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+        cursor.close()
+
+
+def commit_or_retry(changes):
+    """
+    Makes the changes of a transaction and commits them. While SQLite reports the database
+    as locked by another writer, the transaction is rolled back and the changes are made
+    again, up to SQLITE_BUSY_RETRIES times.
+
+    :param changes: a function without arguments that makes the changes in the session
+    :return: what the changes function returned
+    """
+    retries = app.config.get('SQLITE_BUSY_RETRIES', 5)
+    for attempt in range(retries):
+        try:
+            result = changes()
+            db.session.commit()
+            return result
+        except OperationalError as error:
+            db.session.rollback()
+            if 'locked' not in str(error.orig) or attempt == retries - 1:
+                raise
+            app.logger.warning('Database locked, retrying the transaction')
+            time.sleep(random.uniform(0.05, 0.1) * 2 ** attempt)
+
+
 key = app.config["ENCRYPTION_KEY"]
 
+# Generated certificates and letters of subscription, keyed by their validation codes
+document_cache = FileCache(app.config.get('PDF_CACHE_DIR', os.path.join(app.instance_path, 'pdf_cache')),
+                           app.config.get('PDF_CACHE_MAX_SIZE', 200 * 1024 * 1024),
+                           suffix='.pdf')
+
+# Pages of Wikiversity rendered as pdf, keyed by their title and revision
+wikiversity_pdf_cache = FileCache(app.config.get('WIKIVERSITY_PDF_CACHE_DIR', os.path.join(app.instance_path, 'wikiversity_pdf_cache')),
+                                  app.config.get('WIKIVERSITY_PDF_CACHE_MAX_SIZE', 500 * 1024 * 1024),
+                                  suffix='.pdf')
+
+# Wikitext of the revisions of the activities seen by the coordinators, by page and revid
+activity_cache = FileCache(app.config.get('ACTIVITY_CACHE_DIR', os.path.join(app.instance_path, 'activity_cache')),
+                           app.config.get('ACTIVITY_CACHE_MAX_SIZE', 50 * 1024 * 1024),
+                           suffix='.txt')
+
+# Where the pages and their rendered pdf files are fetched from
+WIKIVERSITY_URL = app.config.get('WIKIVERSITY_URL', 'https://pt.wikiversity.org')
+
+# The calls to Wikiversity that aren't signed by the user share its kept-alive connections
+wikiversity = requests.Session()
+with app.app_context():
+    wikiversity.mount('https://', pooled_adapter())
+    wikiversity.mount('http://', pooled_adapter())
+
+# Shared by every request, so the process never fetches more than this many pdf files
+# from the Wikimedia renderer at once
+wikiversity_pdf_fetcher = ThreadPoolExecutor(max_workers=app.config.get('WIKIVERSITY_PDF_WORKERS', 6))
+
 
 # Create database (db) model
 class Users(db.Model):
+    __table_args__ = (db.Index('ix_users_solicited_certificate_completed', 'solicited_certificate', 'completed'),)
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), nullable=False, unique=True)
-    full_name = db.Column(StringEncryptedType(db.String(300), key), nullable=False)
+    # Deferred, so queries that don't show the name never pay for its decryption
+    full_name = db.deferred(db.Column(StringEncryptedType(db.String(300), key), nullable=False))
     date_created = db.Column(db.DateTime, default=datetime.utcnow())
     date_modified = db.Column(db.DateTime, default=datetime.utcnow())
-    can_download_certificate = db.Column(db.String(), nullable=False)
     solicited_certificate = db.Column(db.Boolean, nullable=False, default=False)
+    subscription_code = db.Column(db.String(40), index=True)
+    certificate_code = db.Column(db.String(40), index=True)
+    # Counted again by update_modules_counters whenever the status of the modules changes
+    approved_modules = db.Column(db.Integer, nullable=False, default=0)
+    denied_modules = db.Column(db.Integer, nullable=False, default=0)
+    not_presented_modules = db.Column(db.Integer, nullable=False, default=0)
+    submitted_modules = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    modules = db.relationship('ModuleStatus', order_by='ModuleStatus.module', lazy='selectin',
+                              cascade='all, delete-orphan')
+
+    def update_validation_codes(self):
+        """
+        Materializes the validation codes printed on the subscription letter and on the
+        certificate, so that /validate can find a document with a single indexed lookup.
+        """
+        self.subscription_code = validation_code("Subscription", self.username, self.date_modified)
+        self.certificate_code = validation_code("Certificate", self.username, self.date_modified)
+
+
+# Status of the activity of a user in a course module. The status is one of "NP" (not
+# presented), "S" (page of the activity edited, found by `flask --app app poll-activities`),
+# "F" (presented, not approved) or "T" (approved). The revid is the latest revision of the
+# page of the activity seen by the poller
+class ModuleStatus(db.Model):
+    __tablename__ = 'module_status'
+    __table_args__ = (db.Index('ix_module_status_module_status', 'module', 'status'),
+                      db.Index('ix_module_status_status_user_id', 'status', 'user_id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    module = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(2), nullable=False, default="NP")
+    revid = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# A document generated in the background by the `flask --app app run-jobs` workers. The
+# status of a job goes from "queued" to "running" and then to "done" or "failed"
+class Job(db.Model):
+    # A user has at most one pending job of each kind, even if the same document is submitted twice at once
+    __table_args__ = (db.Index('ix_job_status_id', 'status', 'id'),
+                      db.Index('ix_job_pending', 'username', 'kind', unique=True,
+                               sqlite_where=db.text("status IN ('queued', 'running')")))
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    username = db.Column(db.String(150), nullable=False, index=True)
+    status = db.Column(db.String(10), nullable=False, default="queued")
+    artifact_key = db.Column(db.String(200))
+    error = db.Column(db.String())
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    date_modified = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# A request for a certificate to be emailed to the coordinators by `flask --app app send-emails`.
+# It is written in the same transaction as the request, and marked as sent once mailed
+class OutboxEmail(db.Model):
+    __tablename__ = 'outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(150), nullable=False)
+    full_name = db.Column(StringEncryptedType(db.String(300), key), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String())
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    date_sent = db.Column(db.DateTime, index=True)
+
+
+# How far a background process has read a feed of Wikiversity, so that it resumes from there:
+# the id and the timestamp of the last change read
+class Checkpoint(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.String(20), nullable=False)
+
+
+def validation_code(document, username, date_modified):
+    """
+    Computes the validation code of a document issued to a user
+
+    :param document: the kind of document, "Subscription" or "Certificate"
+    :param username: the username of the user the document was issued to
+    :param date_modified: the last modification date of the user subscription
+    :return: the SHA-1 hex digest printed on the footer of the document
+    """
+    return hashlib.sha1(bytes(document + " " + username + str(date_modified), 'utf-8')).hexdigest()
+
+
+# Activity page of each module, to be completed with the username of the student
+MODULES_ACTIVITIES_URLS = [
+    "https://pt.wikiversity.org/wiki/Introdução_ao_Jornalismo_Científico/Metodologia_e_Filosofia_da_Ciência/Atividade/",
+    "https://outreachdashboard.wmflabs.org/courses/CEPID_NeuroMat/Introdu%C3%A7%C3%A3o_ao_Jornalismo_Cient%C3%ADfico/students/articles/",
+    "https://pt.wikiversity.org/wiki/Introdução_ao_Jornalismo_Científico/Ética_da_Ciência/Atividade/",
+    "https://pt.wikiversity.org/wiki/Introdução_ao_Jornalismo_Científico/Temas_Centrais_da_Ciência_Contemporânea/Atividade/",
+    "https://pt.wikiversity.org/wiki/Introdução_ao_Jornalismo_Científico/Modos_de_Organização_e_Financiamento_dos_Sistemas_de_Pesquisa,_no_Brasil_e_no_Exterior/Atividade/",
+    "https://pt.wikiversity.org/wiki/Introdução_ao_Jornalismo_Científico/Mídias,_Linguagens_e_Prática_do_Jornalismo_Científico/Atividade/"]
+
+# Page of Wikiversity with the activity of each module, to be completed with the username of the student
+MODULES_ACTIVITIES_TITLES = [
+    "Introdução_ao_Jornalismo_Científico/Metodologia_e_Filosofia_da_Ciência/Atividade/",
+    "Introdução_ao_Jornalismo_Científico/História_da_Ciência_e_da_Tecnologia/Atividade/",
+    "Introdução_ao_Jornalismo_Científico/Ética_da_Ciência/Atividade/",
+    "Introdução_ao_Jornalismo_Científico/Temas_Centrais_da_Ciência_Contemporânea/Atividade/",
+    "Introdução_ao_Jornalismo_Científico/Modos_de_Organização_e_Financiamento_dos_Sistemas_de_Pesquisa,_no_Brasil_e_no_Exterior/Atividade/",
+    "Introdução_ao_Jornalismo_Científico/Mídias,_Linguagens_e_Prática_do_Jornalismo_Científico/Atividade/"]
+
+# Columns the coordinators can sort the students table by
+DASHBOARD_SORTING = {'username': Users.username,
+                     'date_created': Users.date_created,
+                     'date_modified': Users.date_modified,
+                     'approved_modules': Users.approved_modules,
+                     'submitted_modules': Users.submitted_modules}
+
+
+def update_modules_status(user_id, status, module=None, current_status=None):
+    """
+    Updates the status of the modules activities of a user with a single UPDATE statement
+
+    :param user_id: the id of the user
+    :param status: the new status of the modules
+    :param module: the module to update, all of them if not given
+    :param current_status: if given, only the modules currently in this status are updated
+    :return: the number of modules updated
+    """
+    statement = db.update(ModuleStatus).where(ModuleStatus.user_id == user_id)
+    if module is not None:
+        statement = statement.where(ModuleStatus.module == module)
+    if current_status is not None:
+        statement = statement.where(ModuleStatus.status == current_status)
+    updated = db.session.execute(statement.values(status=status, updated_at=datetime.utcnow())).rowcount
+    if updated:
+        update_modules_counters([user_id])
+    return updated
+
+
+def update_modules_counters(user_ids=None):
+    """
+    Counts again the modules of users in each status, and whether they completed the course,
+    with a single UPDATE statement. It must be called in the same transaction as any change
+    of the status of the modules.
+
+    :param user_ids: the ids of the users, all users if not given
+    """
+    def count(status):
+        return db.select(db.func.count()).where(ModuleStatus.user_id == Users.id,
+                                                ModuleStatus.status == status).scalar_subquery()
+
+    statement = db.update(Users)
+    if user_ids is not None:
+        statement = statement.where(Users.id.in_(user_ids))
+    db.session.execute(statement.values(approved_modules=count("T"),
+                                        denied_modules=count("F"),
+                                        not_presented_modules=count("NP"),
+                                        submitted_modules=count("S"),
+                                        completed=count("T") == app.config["NUMBER_OF_MODULES"]))
+
+
+def update_solicited_certificate(user_id, solicited, current=None):
+    """
+    Sets whether a user requested the certificate with a single UPDATE statement
+
+    :param user_id: the id of the user
+    :param solicited: True if the user requested the certificate
+    :param current: if given, the user is only updated if this is the current value
+    :return: the number of users updated, 1 or 0
+    """
+    statement = db.update(Users).where(Users.id == user_id)
+    if current is not None:
+        statement = statement.where(Users.solicited_certificate.is_(current))
+    return db.session.execute(statement.values(solicited_certificate=solicited)).rowcount
+
+
+def completion_summary():
+    """
+    :return: the number of users who completed the course and of users whose request for
+    the certificate awaits review, counted on the indexes of the users table
+    """
+    completed = db.select(db.func.count()).where(Users.completed.is_(True)).scalar_subquery()
+    pending_review = db.select(db.func.count()).where(Users.solicited_certificate.is_(True),
+                                                      Users.completed.is_(False)).scalar_subquery()
+    return db.session.execute(db.select(completed.label('completed'),
+                                        pending_review.label('pending_review'))).one()._asdict()
+
 
+@db.event.listens_for(Users, 'before_insert')
+@db.event.listens_for(Users, 'before_update')
+def keep_validation_codes_in_sync(mapper, connection, target):
+    if target.date_modified is None:
+        target.date_modified = datetime.utcnow()
+    target.update_validation_codes()
+
+
+class CachedResourcesPDF(FPDF):
+    """
+    FPDF document that parses each font and decodes each image only once per process.
+    The parsed resources are kept at class level and copied into every new document,
+    so only the first document generated by a worker pays for reading the files.
+    """
+    cached_fonts = {}
+    cached_images = {}
+    # FPDF pickles the parsed fonts next to the font files, so two threads parsing the same
+    # font at once may read a half written file
+    fonts_lock = threading.Lock()
+
+    def add_font(self, family, style='', fname='', uni=False):
+        fontkey = family.lower() + style.upper()
+        if fontkey in self.fonts:
+            return
+        with span('fonts'):
+            if fontkey not in CachedResourcesPDF.cached_fonts:
+                with CachedResourcesPDF.fonts_lock:
+                    # Another thread may have parsed it while this one waited
+                    if fontkey not in CachedResourcesPDF.cached_fonts:
+                        FPDF.add_font(self, family, style, fname, uni)
+                        # Keep a pristine copy, as the document appends the used characters to the subset
+                        CachedResourcesPDF.cached_fonts[fontkey] = (dict(self.fonts[fontkey], subset=list(self.fonts[fontkey]['subset'])),
+                                                                    dict(self.font_files[fontkey]),
+                                                                    fname)
+                        return
+            font, font_file, font_fname = CachedResourcesPDF.cached_fonts[fontkey]
+            self.fonts[fontkey] = dict(font, i=len(self.fonts) + 1, subset=list(font['subset']))
+            self.font_files[fontkey] = dict(font_file)
+            self.font_files[font_fname] = {'type': "TTF"}
+
+    def image(self, name, *args, **kwargs):
+        with span('images'):
+            if name not in self.images and name in CachedResourcesPDF.cached_images:
+                self.images[name] = dict(CachedResourcesPDF.cached_images[name], i=len(self.images) + 1)
+                # Decoding an image with alpha channel is what raises the document to PDF 1.4
+                if 'smask' in self.images[name] and self.pdf_version < '1.4':
+                    self.pdf_version = '1.4'
+            FPDF.image(self, name, *args, **kwargs)
+            if name not in CachedResourcesPDF.cached_images:
+                # The document drops the image data once it is written, so the cache keeps its own copy
+                CachedResourcesPDF.cached_images[name] = dict(self.images[name])
+
+
+class SubsPDF(CachedResourcesPDF):
+    validation_code = ''
 
-class SubsPDF(FPDF):
     def header(self):
         self.image(os.path.join(app.static_folder, 'A_los_derechos_humanos_cropped.jpg'), x=0, y=0, w=210, h=32)
         # Box for the title
@@ -60,46 +388,612 @@ class SubsPDF(FPDF):
         self.cell(w=150, h=12, border=0, ln=1, align='C', fill=True, txt='INTRODUÇÃO AO JORNALISMO CIENTÍFICO')
 
     def footer(self):
-        username = get_username()
-        user = Users.query.filter_by(username=username).first()
-        date_modified = user.date_modified
-        user_hash = hashlib.sha1(bytes("Subscription " + username + str(date_modified), 'utf-8')).hexdigest()
         self.set_y(-16.5)
         self.set_font('Times', '', 8.8)
         self.cell(w=0, h=6.5, border=0, ln=1, align='C',
                   txt='A validade deste documento pode ser checada em https://ijc.toolforge.org/. '
-                      'O código de validação é: ' + user_hash)
+                      'O código de validação é: ' + self.validation_code)
     pass
 
 
-class CertificationPDF(FPDF):
+# Fonts of the certificate, by the family name given to add_font
+CERTIFICATE_FONTS = {'Merriweather': 'fonts/Merriweather-Regular.ttf',
+                     'Merriweather-Bold': 'fonts/Merriweather-Bold.ttf'}
+
+
+class GlyphWidths(dict):
+    """
+    The width of each character in a font, in thousandths of the font size, as FPDF
+    measures it: the characters without a glyph are 0 wide if their code point is in the
+    table of the font, and as wide as the missing glyph past the end of the table.
+    """
+    def __init__(self, table):
+        super().__init__((chr(int(code_point)), width) for code_point, width in table['widths'].items())
+        self.length = table['length']
+        self.missing = table['missing']
+
+    def __missing__(self, char):
+        return 0 if ord(char) < self.length else self.missing
+
+
+@functools.lru_cache(maxsize=None)
+def font_widths(font):
+    """
+    Reads the table of the widths of the glyphs of a font of the certificate, stored next
+    to the font file, so that text can be measured without an FPDF document. The table is
+    built from the font file, the same way FPDF reads it, if it isn't there yet.
+
+    :param font: the family name of the font, a key of CERTIFICATE_FONTS
+    :return: the width of each character
+    """
+    fname = os.path.join(app.static_folder, CERTIFICATE_FONTS[font])
+    table_fname = os.path.splitext(fname)[0] + '.widths.json'
+    try:
+        with open(table_fname) as file:
+            return GlyphWidths(json.load(file))
+    except OSError:
+        pass
+
+    ttf = TTFontFile()
+    ttf.getMetrics(fname)
+    table = {'length': len(ttf.charWidths),
+             'widths': {code_point: width for code_point, width in enumerate(ttf.charWidths) if width},
+             'missing': int(round(ttf.defaultWidth, 0)) or 500}
+    try:
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(fname), suffix='.tmp', delete=False) as file:
+            json.dump(table, file, sort_keys=True)
+        os.chmod(file.name, 0o644)
+        os.replace(file.name, table_fname)
+    except OSError:
+        pass
+    return GlyphWidths(table)
+
+
+def string_width(text, font, size):
+    """
+    Measures a text as FPDF.get_string_width does, in millimeters
+
+    :param text: the text
+    :param font: the family name of the font, a key of CERTIFICATE_FONTS
+    :param size: the size of the font, in points
+    :return: the width of the text
+    """
+    return sum(map(font_widths(font).__getitem__, text)) * (size / (72 / 25.4)) / 1000.0
+
+
+@functools.lru_cache(maxsize=4096)
+def fit_name(name, font='Merriweather', size=35, max_width=287):
+    """
+    Fits a name in the width of the certificate. A name too long has its middle names
+    abbreviated, leaving out the prepositions, and if it still doesn't fit, the font
+    size is reduced.
+
+    :param name: the full name of the user
+    :param font: the family name of the font, a key of CERTIFICATE_FONTS
+    :param size: the size of the font, in points
+    :param max_width: the width available, in millimeters
+    :return: the name as printed and the size of its font
+    """
+    name_size = string_width(name, font, size)
+
+    if name_size > max_width:
+        # Try to eliminate the prepositions
+        name_split = [name_part for name_part in name.split(' ') if not name_part.islower()]
+        # There's a first and last names and at least one middle name
+        if len(name_split) > 2:
+            first_name = name_split[0]
+            last_name = name_split[-1]
+            middle_names = [md_name[0]+'.' for md_name in name_split[1:-1]]
+            name = first_name + ' ' + ' '.join(middle_names) + ' ' + last_name
+            name_size = string_width(name, font, size)
+
+        # Even abbreviating, there is still the possibility that the name is too big, so
+        # we need to adjust it to the proper size
+        if name_size > max_width:
+            size = math.floor(max_width * size / name_size)
+
+    return name, size
+
+
+class CertificationPDF(CachedResourcesPDF):
+    validation_code = ''
+
     def header(self):
         self.image(os.path.join(app.static_folder, 'background_certificado.jpg'), x=0, y=0, w=297, h=210)
 
     def footer(self):
-        username = get_username()
-        user = Users.query.filter_by(username=username).first()
-        date_modified = user.date_modified
-        user_hash = hashlib.sha1(bytes("Certificate " + username + str(date_modified), 'utf-8')).hexdigest()
         self.set_y(-16.5)
         self.set_font('Merriweather', '', 8.8)
         self.cell(w=0, h=6.5, border=0, ln=1, align='C',
                   txt='A validade deste documento pode ser checada em https://ijc.toolforge.org/. '
-                      'O código de validação é: ' + user_hash)
+                      'O código de validação é: ' + self.validation_code)
     pass
 
 
+########################################################################################################################
+# D O C U M E N T S
+########################################################################################################################
+def subscription_letter_pdf(username, full_name, validation_code):
+    """
+    Lays out the letter of subscription of a user
+
+    :param username: the username of the user
+    :param full_name: the full name of the user
+    :param validation_code: the validation code printed on the footer
+    :return: the pdf file, as bytes
+    """
+    # Create page
+    pdf = SubsPDF(orientation='P', unit='mm', format='A4')
+    pdf.validation_code = validation_code
+    pdf.add_page()
+
+    #######################################################################################################
+    # Data
+    #######################################################################################################
+    pdf.set_xy(10, 42)                          # Start the letter text at the 10x42mm point
+
+    pdf.set_font('Times', '', 13)               # Text of the body in Times New Roman, regular, 13 pt
+
+    locale.setlocale(locale.LC_TIME, "pt_BR")   # Setting the language to portuguese for the date
+    pdf.cell(w=150, h=6, border=0, ln=1, align='L',
+             txt='São Paulo, ' + datetime.now().strftime("%d de %B de %Y"))
+
+    pdf.cell(w=0, h=6, ln=1)                  # New line
+
+    #######################################################################################################
+    # A quem possa interessar
+    #######################################################################################################
+    pdf.set_font('Times', 'B', 13)              # Text of the addressing in Times New Roman, bold, 13 pt
+    pdf.cell(w=150, h=6, txt='A quem possa interessar', border=0, ln=1, align='L')
+
+    pdf.cell(w=0, h=6, ln=1)                  # New line
+
+    name = full_name                                            # User full name
+
+    #######################################################################################################
+    # Text
+    #######################################################################################################
+    pdf.set_font('Times', '', 13)               # Text of the body in Times New Roman, regular, 13 pt
+    pdf.multi_cell(w=0,
+                   h=6,
+                   txt="O curso de Introdução ao Jornalismo Científico, desenvolvido pelo Centro de Pesquisa, Inovação "
+                       "e Difusão em Neuromatemática com o apoio da FAPESP e do Wiki Movimento Brasil, está disponível "
+                       "em uma plataforma de educação aberta, a Wikiversidade.\n\n"
+                       "As aulas foram realizadas, com orientação científica da equipe de pesquisa do CEPID NeuroMat, "
+                       "por bolsistas de jornalismo científico da FAPESP. O objetivo do curso é capacitar profissio"
+                       "nais de comunicação na cobertura jornalística especializada em ciência. Está também direciona"
+                       "do ao atendimento ao exposto no edital Mídia Ciência, da FAPESP.\n\n"
+                       "O curso é livre e o controle das atividades é realizado por recursos na Wikimedia. "
+                       "Esta carta certifica que "
+                       + name +
+                       " está apto(a) a participar do curso de Introdução ao "
+                       "Jornalismo Científico e comprova sua matrícula, pela plataforma de registro IJC (https://ijc.toolforge.org).\n\n"
+                       "Atestamos para os devidos fins, portanto, que "
+                       + name +
+                       " realiza o curso de Introdução ao Jornalismo Científico. A realização do curso pode ser verificada "
+                       "na página de acompanhamento das atividades, que monitora o progresso do(a) estudante:\n",
+                   border=0,
+                   align='J')
+    outreach_link = "https://outreachdashboard.wmflabs.org/courses/CEPID_NeuroMat/Introdução_ao_Jornalismo_Científico/students/articles/" + username
+    safe_outreach_link = "https://outreachdashboard.wmflabs.org/courses/CEPID_NeuroMat/Introdu%C3%A7%C3%A3o_ao_Jornalismo_Cient%C3%ADfico/students/articles/" + username
+    pdf.multi_cell(w=0,
+                   h=6,
+                   txt=outreach_link + "\n\n",
+                   border=0,
+                   align='J')
+    x = pdf.get_x()
+    y = pdf.get_y()
+    w = pdf.get_string_width(outreach_link)
+    h = 6
+    pdf.link(x=x,
+             y=y-3*h,
+             w=w,
+             h=2*h,
+             link=safe_outreach_link)
+    pdf.multi_cell(w=0,
+                   h=6,
+                   txt="Caso requisitado, podemos emitir uma declaração de conclusão do curso, uma vez que o(a) "
+                       "participante tenha finalizado todas as leituras e tarefas.\n\n"
+                       "Por favor, não hesitem em entrar em contato conosco para receber outras informações a respeito "
+                       "do curso.\n\n"
+                       "Atenciosamente,",
+                   border=0,
+                   align='J')
+
+    #######################################################################################################
+    # Footer
+    #######################################################################################################
+    pdf.cell(w=0, h=13, ln=1)                   # Give some space for the signatures
+    # Fernando da Paixão signature
+    pdf.image(os.path.join(app.static_folder, 'fpaixao.png'), x=37.5, y=234, w=35, h=16)
+    pdf.set_y(240)
+    pdf.multi_cell(w=90,
+                   h=6,
+                   txt="_____________________________________\n"
+                       "FERNANDO JORGE DA\nPAIXÃO FILHO\nCoordenador da equipe de\ndifusão do CEPID NeuroMat",
+                   border=0,
+                   align='C')
+
+    # João Alexandre Peschanski signature
+    pdf.image(os.path.join(app.static_folder, 'jap.png'), x=137.5, y=236, w=35, h=16)
+    pdf.set_xy(110, 240)
+    pdf.multi_cell(w=90,
+                   h=6,
+                   txt="_____________________________________\n"
+                       "JOÃO ALEXANDRE\nPESCHANSKI\nPesquisador associado\ndo CEPID NeuroMat",
+                   border=0,
+                   align='C')
+    pdf.cell(w=0, h=5, ln=1)
+
+    # Generate the file
+    return pdf.output(dest='S').encode('latin-1')
+
+
+def cached_pdf_response(cache_key, build, disposition, filename):
+    """
+    Serves a generated pdf file from the documents cache, generating and storing it on a
+    miss. The cache key is also the ETag of the response, so browsers downloading the
+    same document again get a 304 without the file being read or generated.
+
+    :param cache_key: the key of the document, derived from its validation code
+    :param build: a function without arguments that generates the pdf file
+    :param disposition: the Content-Disposition of the response, 'inline' or 'attachment'
+    :param filename: the name of the downloaded file
+    :return: the response with the pdf file
+    """
+    if request.if_none_match.contains(cache_key):
+        response = Response(status=304)
+    else:
+        file = document_cache.get(cache_key)
+        if file is None:
+            with span('pdf'):
+                file = build()
+            document_cache.put(cache_key, file)
+
+        response = make_response(file)
+        response.headers.set('Content-Disposition', disposition, filename=filename)
+        response.headers.set('Content-Type', 'application/pdf')
+    response.set_etag(cache_key)
+    response.headers.set('Cache-Control', 'private, no-cache')
+    return response
+
+
+def certificate_pdf(full_name, validation_code):
+    """
+    Lays out the certificate of conclusion of the course of a user
+
+    :param full_name: the full name of the user
+    :param validation_code: the validation code printed on the footer
+    :return: the pdf file, as bytes
+    """
+    # Create page
+    pdf = CertificationPDF(orientation='L', unit='mm', format='A4')
+    pdf.validation_code = validation_code
+    pdf.add_page()
+    pdf.set_text_color(0, 46, 75)
+
+    #######################################################################################################
+    # Header
+    #######################################################################################################
+    pdf.set_y(20)                          # Start the letter text at the 10x42mm point
+
+    for family, fname in CERTIFICATE_FONTS.items():
+        pdf.add_font(family, '', os.path.join(app.static_folder, fname), uni=True)
+    pdf.set_font('Merriweather', '', 37)               # Text of the body in Times New Roman, regular, 13 pt
+
+    locale.setlocale(locale.LC_TIME, "pt_BR")   # Setting the language to portuguese for the date
+    pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='CERTIFICADO')
+
+    pdf.set_font('Merriweather', '', 14.5)
+    pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='Concedemos este certificado a')
+    pdf.cell(w=0, h=10, ln=1)                  # New line
+
+    #######################################################################################################
+    # User name
+    #######################################################################################################
+    name, name_font_size = fit_name(full_name)                  # User full name, fitted in the page
+    pdf.set_font('Merriweather', '', name_font_size)
+
+    pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt=name)
+    pdf.cell(w=0, h=10, ln=1)  # New line
+
+    #######################################################################################################
+    # por ter completado as leituras e as 6 tarefas do curso online
+    #######################################################################################################
+    pdf.set_font('Merriweather', '', 14.5)
+    pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='por ter completado as leituras e as ' +
+                                                       str(app.config["NUMBER_OF_MODULES"]) +
+                                                       ' tarefas do curso online')
+
+    #######################################################################################################
+    # Introdução ao Jornalismo Científico
+    #######################################################################################################
+    pdf.set_font('Merriweather-Bold', '', 21)
+    pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='Introdução ao Jornalismo Científico')
+    pdf.cell(w=0, h=8, ln=1)  # New line
+
+    #######################################################################################################
+    # Logo NeuroMat
+    #######################################################################################################
+    pdf.set_font('Merriweather', '', 12.5)
+    pdf.set_x(50)
+    y_production = pdf.get_y()
+    pdf.cell(w=20, h=10, border=0, ln=0, align='L', txt='Produção:')
+    y_logos = pdf.get_y()
+    pdf.image(os.path.join(app.static_folder, 'neuromat.png'), x=78, y=y_production+0.6, h=8.5)
+
+    #######################################################################################################
+    # Logo FAPESP and WMB
+    #######################################################################################################
+    pdf.set_xy(155, y_production)
+    pdf.cell(w=20, h=10, border=0, ln=1, align='L', txt='Apoio:')
+    pdf.image(os.path.join(app.static_folder, 'fapesp.png'), x=175, y=y_production+1.1, h=7)
+    pdf.image(os.path.join(app.static_folder, 'wmb.png'), x=215, y=y_production-1.1, h=13)
+
+    pdf.cell(w=0, h=5, ln=1)  # New line
+
+    #######################################################################################################
+    # Footer
+    #######################################################################################################
+    y_signature = pdf.get_y()                   # Register the "y" position, so the signatures are aligned
+
+    # Fernando da Paixão signature
+    pdf.image(os.path.join(app.static_folder, 'fpaixao.png'), x=75, y=y_signature, w=35, h=16)
+    pdf.set_xy(50, y_signature+6)
+    pdf.multi_cell(w=90,
+                   h=6.5,
+                   txt="______________________\n"
+                       "FERNANDO JORGE DA\nPAIXÃO FILHO\n\nCoordenador da equipe de\ndifusão do CEPID NeuroMat",
+                   border=0,
+                   align='C')
+
+    # João Alexandre Peschanski signature
+    pdf.image(os.path.join(app.static_folder, 'jap.png'), x=180, y=y_signature+2, w=35, h=16)
+    pdf.set_xy(155, y_signature+6)
+    pdf.multi_cell(w=90,
+                   h=6.5,
+                   txt="______________________\n"
+                       "JOÃO ALEXANDRE\nPESCHANSKI\n\nPesquisador associado\ndo CEPID NeuroMat",
+                   border=0,
+                   align='C')
+    pdf.cell(w=0, h=10, ln=1)  # New line
+    pdf.set_font('Merriweather', '', 10.5)
+
+    # Text
+    pdf.set_x(25)
+    pdf.multi_cell(w=247, h=10, border=0, align='C', txt='O curso de Introdução ao Jornalismo Científico não tem um '
+                                                         'controle de registros, as leituras e tarefas são de acesso '
+                                                         'livre. Este certificado, portanto, não é reconhecido como '
+                                                         'um diploma oficial. O curso totaliza para sua realização '
+                                                         'noventa horas.')
+
+    # Generate the file
+    return pdf.output(dest='S').encode('latin-1')
+
+
+def cached_certificate_pdf(user):
+    """
+    Gets the certificate of a user from the documents cache, or generates it without
+    storing it, so that issuing the certificates of a whole cohort doesn't evict the
+    documents the students download
+
+    :param user: a (full_name, certificate_code) tuple
+    :return: the pdf file, as bytes
+    """
+    full_name, certificate_code = user
+    file = document_cache.get('certificate_' + certificate_code)
+    if file is None:
+        file = certificate_pdf(full_name, certificate_code)
+    return file
+
+
+def load_certificate_resources():
+    """
+    Parses the fonts and images of the certificates, once in each process of the pool
+    """
+    certificate_pdf('', '')
+
+
+def issue_certificates(users, processes=1):
+    """
+    Generates the certificates of many users, in this process or in a pool of processes.
+    The pool is started by a fresh server process rather than forked from this one, so
+    the workers don't inherit its locks, its database connections nor its sockets, and it
+    is only meant for the issue-certificates command, never for the web workers.
+
+    :param users: a list of (full_name, certificate_code) tuples
+    :param processes: the number of processes
+    :return: the pdf files, as bytes, in the order of the users, each yielded as soon as generated
+    """
+    if not users:
+        return
+    if processes == 1 or len(users) == 1:
+        yield from map(cached_certificate_pdf, users)
+        return
+
+    # FPDF writes the widths of the fonts next to them the first time they are parsed, which
+    # the workers would otherwise race to do
+    load_certificate_resources()
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        # The server imports the app once, and the workers are forked from it
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context('spawn')
+    with context.Pool(processes, initializer=load_certificate_resources) as pool:
+        yield from pool.imap(cached_certificate_pdf, users, chunksize=4)
+
+
+def zip_stream(files):
+    """
+    Writes a zip file while its entries are generated
+
+    :param files: an iterable of (filename, content as bytes) tuples
+    :return: the chunks of the zip file, each yielded as soon as an entry is written
+    """
+    chunks = []
+
+    # The zip file is written to a stream that can't seek, so it uses data descriptors
+    class Output:
+        def write(self, data):
+            chunks.append(bytes(data))
+            return len(data)
+
+        def flush(self):
+            pass
+
+    with zipfile.ZipFile(Output(), 'w', compression=zipfile.ZIP_STORED) as archive:
+        for filename, content in files:
+            archive.writestr(filename, content)
+            yield b''.join(chunks)
+            chunks.clear()
+    yield b''.join(chunks)
+
+
+def merged_pdf(files):
+    """
+    :param files: an iterable of pdf files, as bytes
+    :return: a single pdf file with all pages of the files, as a temporary file opened for reading
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=app.config.get('ATTACHMENT_SPOOL_SIZE', 5 * 1024 * 1024))
+    writer = PdfFileWriter()
+    for file in files:
+        reader = PdfFileReader(io.BytesIO(file))
+        for i in range(reader.getNumPages()):
+            writer.addPage(reader.getPage(i))
+    writer.write(output)
+    output.seek(0)
+    return output
+
+
+def completed_users(prefix='', usernames=None):
+    """
+    :param prefix: if given, only the users whose username starts with it
+    :param usernames: if given, only these users
+    :return: a list with the username, full name and certificate code of the users who
+    completed the course, ordered by username
+    """
+    query = db.session.query(Users.username, Users.full_name, Users.certificate_code)\
+        .filter(Users.completed.is_(True))
+    if prefix:
+        query = query.filter(Users.username.startswith(prefix, autoescape=True))
+    if usernames:
+        query = query.filter(Users.username.in_(usernames))
+    return query.order_by(Users.username).all()
+
+
+def certificates_filename(username):
+    return 'IJC_Certificado_' + username.replace(' ', '_') + '.pdf'
+
+
 ########################################################################################################################
 # L O G I N
 ########################################################################################################################
+# Latency of the routes served by this process, exposed on /metrics
+metrics = Metrics()
+
+
 @app.before_request
 def init_profile():
     g.profiling = []
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def report_profile(response):
+    """
+    Sends the time spent in database queries, API calls and pdf generation in the
+    Server-Timing header, and adds the request to the latency histograms.
+    """
+    if 'request_started' in g:
+        duration = time.perf_counter() - g.request_started
+        response.headers.set('Server-Timing', server_timing(g.profiling, duration))
+        metrics.observe(request.endpoint or 'not_found', duration, g.profiling)
+    return response
+
+
+@db.event.listens_for(db.Engine, 'before_cursor_execute')
+def start_query_span(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, which is dropped along with a statement that fails
+    context.query_started = time.perf_counter()
+
+
+@db.event.listens_for(db.Engine, 'after_cursor_execute')
+def end_query_span(conn, cursor, statement, parameters, context, executemany):
+    record('db', time.perf_counter() - context.query_started)
+
+
+@app.route('/metrics')
+def metrics_page():
+    """
+    This page shows the latency of each route in the Prometheus text format, for the coordinators
+
+    :return: The metrics of this process, as plain text
+    """
+    if g.user not in app.config['COORDINATORS_USERNAMES']:
+        return 'Acesso negado', 403
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
 
 
 @app.before_request
 def global_user():
+    """
+    Loads the logged user once per request. The views and the documents they generate
+    read it from g.current_user instead of querying it again.
+    """
+    g.user = None
+    g.current_user = None
+    # The fonts, images and stylesheets don't need the user
+    if request.endpoint in (None, 'static'):
+        return
     g.user = get_username()
+    if g.user:
+        query = Users.query.options(db.lazyload(Users.modules))
+        # The full name is only decrypted for the views that show it
+        if request.endpoint in FULL_NAME_ENDPOINTS:
+            query = query.options(db.undefer(Users.full_name))
+        g.current_user = query.filter_by(username=g.user).first()
+
+
+# The views that show the full name of the logged user, or print it on a document
+FULL_NAME_ENDPOINTS = {'certificate', 'subscription', 'subscription_letter', 'generate_certificate',
+                       'generate_attachment', 'solicit_certificate', 'download_job'}
+
+
+# The most SQL statements each view may run, checked in debug mode only
+SQL_STATEMENTS_PER_ROUTE = {'home': 1,
+                            'metrics_page': 1,
+                            'subscription': 5,
+                            'update_subscription': 6,
+                            'subscription_letter': 1,
+                            'generate_certificate': 1,
+                            'generate_attachment': 1,
+                            'validate_document': 2,
+                            'course_index': 1,
+                            'certificate': 6,
+                            'certificate_only_requested': 6,
+                            'solicit_certificate': 5,
+                            'deny_solicitation_for_certificate': 3,
+                            'approve_certification_without_request': 5,
+                            'approve_certification': 4,
+                            'deny_certification': 4,
+                            'decide_certifications': 8,
+                            'bulk_certificates': 2,
+                            'activities_revisions': 1,
+                            'activity': 1,
+                            'submit_job': 4,
+                            'job_status_page': 2,
+                            'download_job': 2}
+
+
+@app.after_request
+def check_sql_statements(response):
+    if app.config['SQLALCHEMY_RECORD_QUERIES'] and request.endpoint in SQL_STATEMENTS_PER_ROUTE:
+        statements = get_recorded_queries()
+        assert len(statements) <= SQL_STATEMENTS_PER_ROUTE[request.endpoint], \
+            '%s ran %d SQL statements:\n%s' % (request.endpoint, len(statements),
+                                                '\n'.join(statement.statement for statement in statements))
+    return response
 
 
 @app.route('/login')
@@ -118,17 +1012,21 @@ def login():
     if next_page:
         session['after_login'] = next_page
 
+    # The username is resolved again once the new tokens are authorized
+    forget_username()
+
     client_key = app.config['CONSUMER_KEY']
     client_secret = app.config['CONSUMER_SECRET']
 
     base_url = 'https://pt.wikiversity.org/w/index.php'
     request_token_url = base_url + '?title=Special%3aOAuth%2finitiate'
 
-    oauth = OAuth1Session(client_key,
+    oauth = oauth_session(client_key,
                           client_secret=client_secret,
                           callback_uri='oob')
 
-    fetch_response = oauth.fetch_request_token(request_token_url)
+    with span('oauth'):
+        fetch_response = oauth.fetch_request_token(request_token_url)
 
     session['owner_key'] = fetch_response.get('oauth_token')
     session['owner_secret'] = fetch_response.get('oauth_token_secret')
@@ -155,7 +1053,7 @@ def oauth_callback():
     client_key = app.config['CONSUMER_KEY']
     client_secret = app.config['CONSUMER_SECRET']
 
-    oauth = OAuth1Session(client_key,
+    oauth = oauth_session(client_key,
                           client_secret=client_secret,
                           resource_owner_key=session['owner_key'],
                           resource_owner_secret=session['owner_secret'])
@@ -164,15 +1062,17 @@ def oauth_callback():
     verifier = oauth_response.get('oauth_verifier')
     access_token_url = base_url + '?title=Special%3aOAuth%2ftoken'
 
-    oauth = OAuth1Session(client_key,
+    oauth = oauth_session(client_key,
                           client_secret=client_secret,
                           resource_owner_key=session['owner_key'],
                           resource_owner_secret=session['owner_secret'],
                           verifier=verifier)
 
-    oauth_tokens = oauth.fetch_access_token(access_token_url)
+    with span('oauth'):
+        oauth_tokens = oauth.fetch_access_token(access_token_url)
     session['owner_key'] = oauth_tokens.get('oauth_token')
     session['owner_secret'] = oauth_tokens.get('oauth_token_secret')
+    resolve_username()
     next_page = session.get('after_login')
 
     return redirect(next_page)
@@ -190,7 +1090,7 @@ def about():
     :return: A html page with the about content.
     """
 
-    username = get_username()
+    username = g.user
     return render_template('about.html',
                            username=username)
 
@@ -204,7 +1104,7 @@ def home():
     :return: A html page with the initial content.
     """
 
-    username = get_username()
+    username = g.user
     return render_template('home.html',
                            username=username)
 
@@ -218,30 +1118,36 @@ def subscription():
     :return: A html page with a form for subscription
     """
 
-    username = get_username()
+    username = g.user
 
     if username:
         if request.method == 'POST':
             user_name = request.form['Username']
             full_name = request.form['FullName']
-            modules_activities = ["NP" for i in range(app.config["NUMBER_OF_MODULES"])]
+            modules_activities = [ModuleStatus(module=i + 1, status="NP") for i in range(app.config["NUMBER_OF_MODULES"])]
 
             new_subscription = Users(username=user_name,
                                      full_name=full_name,
-                                     can_download_certificate=";".join(modules_activities))
+                                     modules=modules_activities,
+                                     not_presented_modules=len(modules_activities))
+
+            def changes():
+                db.session.add(new_subscription)
+                db.session.flush()
+                return new_subscription.id
 
             # Try to push it to the database
             try:
-                db.session.add(new_subscription)
-                db.session.commit()
-                return redirect(url_for('subscription'))
+                user_id = commit_or_retry(changes)
             except:
                 return 'Ocorreu um erro!'
+            # The changes of the pages of the activities written before were skipped by the poller
+            submit_written_activities(user_id, user_name)
+            return redirect(url_for('subscription'))
         else:
-            user_is_registered = Users.query.filter_by(username=username).first()
             return render_template('subscription.html',
                                    username=username,
-                                   user_is_registered=user_is_registered)
+                                   user_is_registered=g.current_user)
     else:
         return redirect(url_for('home'))
 
@@ -255,20 +1161,24 @@ def update_subscription(user_username):
     :return: A html page with a form for updating the user subscription
     """
 
-    username = get_username()
+    username = g.user
     if username in app.config['COORDINATORS_USERNAMES']:
-        user_to_update = Users.query.filter_by(username=user_username).first()
+        user_to_update = Users.query.options(db.undefer(Users.full_name)).filter_by(username=user_username).first()
 
         if request.method == 'POST':
-            user_to_update.full_name = request.form["FullName"]
-            user_to_update.date_modified = datetime.utcnow()
+            outdated_codes = [user_to_update.subscription_code, user_to_update.certificate_code]
 
-            modules_activities = ["F" for i in range(app.config["NUMBER_OF_MODULES"])]
-            user_to_update.can_download_certificate = ";".join(modules_activities)
+            def changes():
+                user_to_update.full_name = request.form["FullName"]
+                user_to_update.date_modified = datetime.utcnow()
+                update_modules_status(user_to_update.id, "F")
 
             # Try to push it to the database
             try:
-                db.session.commit()
+                commit_or_retry(changes)
+                # The documents issued before the update are no longer valid
+                for outdated_code in outdated_codes:
+                    document_cache.discard('*_' + str(outdated_code) + '*')
                 return redirect(url_for('subscription'))
             except:
                 return 'Ocorreu um erro!'
@@ -289,124 +1199,15 @@ def subscription_letter():
     :return: A pdf file with a letter of subscription
     """
 
-    username = get_username()
+    username = g.user
+    user = g.current_user
 
-    if username:
-        # Create page
-        pdf = SubsPDF(orientation='P', unit='mm', format='A4')
-        pdf.add_page()
-
-        #######################################################################################################
-        # Data
-        #######################################################################################################
-        pdf.set_xy(10, 42)                          # Start the letter text at the 10x42mm point
-
-        pdf.set_font('Times', '', 13)               # Text of the body in Times New Roman, regular, 13 pt
-
-        locale.setlocale(locale.LC_TIME, "pt_BR")   # Setting the language to portuguese for the date
-        pdf.cell(w=150, h=6, border=0, ln=1, align='L',
-                 txt='São Paulo, ' + datetime.now().strftime("%d de %B de %Y"))
-
-        pdf.cell(w=0, h=6, ln=1)                  # New line
-
-        #######################################################################################################
-        # A quem possa interessar
-        #######################################################################################################
-        pdf.set_font('Times', 'B', 13)              # Text of the addressing in Times New Roman, bold, 13 pt
-        pdf.cell(w=150, h=6, txt='A quem possa interessar', border=0, ln=1, align='L')
-
-        pdf.cell(w=0, h=6, ln=1)                  # New line
-
-        #######################################################################################################
-        # User data
-        #######################################################################################################
-        user = Users.query.filter_by(username=username).first()
-
-        name = user.full_name                                       # User full name
-
-        #######################################################################################################
-        # Text
-        #######################################################################################################
-        pdf.set_font('Times', '', 13)               # Text of the body in Times New Roman, regular, 13 pt
-        pdf.multi_cell(w=0,
-                       h=6,
-                       txt="O curso de Introdução ao Jornalismo Científico, desenvolvido pelo Centro de Pesquisa, Inovação "
-                           "e Difusão em Neuromatemática com o apoio da FAPESP e do Wiki Movimento Brasil, está disponível "
-                           "em uma plataforma de educação aberta, a Wikiversidade.\n\n"
-                           "As aulas foram realizadas, com orientação científica da equipe de pesquisa do CEPID NeuroMat, "
-                           "por bolsistas de jornalismo científico da FAPESP. O objetivo do curso é capacitar profissio"
-                           "nais de comunicação na cobertura jornalística especializada em ciência. Está também direciona"
-                           "do ao atendimento ao exposto no edital Mídia Ciência, da FAPESP.\n\n"
-                           "O curso é livre e o controle das atividades é realizado por recursos na Wikimedia. "
-                           "Esta carta certifica que "
-                           + name +
-                           " está apto(a) a participar do curso de Introdução ao "
-                           "Jornalismo Científico e comprova sua matrícula, pela plataforma de registro IJC (https://ijc.toolforge.org).\n\n"
-                           "Atestamos para os devidos fins, portanto, que "
-                           + name +
-                           " realiza o curso de Introdução ao Jornalismo Científico. A realização do curso pode ser verificada "
-                           "na página de acompanhamento das atividades, que monitora o progresso do(a) estudante:\n",
-                       border=0,
-                       align='J')
-        outreach_link = "https://outreachdashboard.wmflabs.org/courses/CEPID_NeuroMat/Introdução_ao_Jornalismo_Científico/students/articles/" + username
-        safe_outreach_link = "https://outreachdashboard.wmflabs.org/courses/CEPID_NeuroMat/Introdu%C3%A7%C3%A3o_ao_Jornalismo_Cient%C3%ADfico/students/articles/" + username
-        pdf.multi_cell(w=0,
-                       h=6,
-                       txt=outreach_link + "\n\n",
-                       border=0,
-                       align='J')
-        x = pdf.get_x()
-        y = pdf.get_y()
-        w = pdf.get_string_width(outreach_link)
-        h = 6
-        pdf.link(x=x,
-                 y=y-3*h,
-                 w=w,
-                 h=2*h,
-                 link=safe_outreach_link)
-        pdf.multi_cell(w=0,
-                       h=6,
-                       txt="Caso requisitado, podemos emitir uma declaração de conclusão do curso, uma vez que o(a) "
-                           "participante tenha finalizado todas as leituras e tarefas.\n\n"
-                           "Por favor, não hesitem em entrar em contato conosco para receber outras informações a respeito "
-                           "do curso.\n\n"
-                           "Atenciosamente,",
-                       border=0,
-                       align='J')
-
-        #######################################################################################################
-        # Footer
-        #######################################################################################################
-        pdf.cell(w=0, h=13, ln=1)                   # Give some space for the signatures
-        # Fernando da Paixão signature
-        pdf.image(os.path.join(app.static_folder, 'fpaixao.png'), x=37.5, y=234, w=35, h=16)
-        pdf.set_y(240)
-        pdf.multi_cell(w=90,
-                       h=6,
-                       txt="_____________________________________\n"
-                           "FERNANDO JORGE DA\nPAIXÃO FILHO\nCoordenador da equipe de\ndifusão do CEPID NeuroMat",
-                       border=0,
-                       align='C')
-
-        # João Alexandre Peschanski signature
-        pdf.image(os.path.join(app.static_folder, 'jap.png'), x=137.5, y=236, w=35, h=16)
-        pdf.set_xy(110, 240)
-        pdf.multi_cell(w=90,
-                       h=6,
-                       txt="_____________________________________\n"
-                           "JOÃO ALEXANDRE\nPESCHANSKI\nPesquisador associado\ndo CEPID NeuroMat",
-                       border=0,
-                       align='C')
-        pdf.cell(w=0, h=5, ln=1)
-
-        # Generate the file
-        file = pdf.output(dest='S').encode('latin-1')
-
-        response = make_response(file)
-        response.headers.set('Content-Disposition', 'inline',
-                             filename='IJC_Inscrição_' + name.replace(" ", "_") + '.pdf')
-        response.headers.set('Content-Type', 'application/pdf')
-        return response
+    if username and user:
+        # The letter is dated, so it is cached for the day only
+        return cached_pdf_response('subscription_' + user.subscription_code + '_' + datetime.now().strftime('%Y-%m-%d'),
+                                   lambda: subscription_letter_pdf(username, user.full_name, user.subscription_code),
+                                   'inline',
+                                   'IJC_Inscrição_' + user.full_name.replace(" ", "_") + '.pdf')
     else:
         return redirect(url_for('home'))
 
@@ -419,21 +1220,17 @@ def validate_document():
 
     :return: A message validating or denying a hash of a document
     """
-    username = get_username()
+    username = g.user
 
     if request.method == 'POST':
         hash_to_be_checked = request.form["hash"]
 
         if hash_to_be_checked:
-            users = Users.query.all()
-            hashs_sub = [
-                hashlib.sha1(bytes("Subscription " + user.username + str(user.date_modified), 'utf-8')).hexdigest()
-                for user in users]
-            hashs_certificate = [
-                hashlib.sha1(bytes("Certificate " + user.username + str(user.date_modified), 'utf-8')).hexdigest()
-                for user in users]
-
-            if hash_to_be_checked in hashs_sub or hash_to_be_checked in hashs_certificate:
+            document_owner = db.session.query(Users.id).filter(
+                db.or_(Users.subscription_code == hash_to_be_checked,
+                       Users.certificate_code == hash_to_be_checked)).first()
+
+            if document_owner:
                 message = True
             else:
                 message = False
@@ -448,12 +1245,36 @@ def validate_document():
 # Baixar índice
 @app.route('/index', methods=['GET'])
 def course_index():
-    base_url = "https://pt.wikiversity.org/api/rest_v1/page/pdf/Programa_de_Introdução_ao_Jornalismo_Científico"
-
-    response = make_response(requests.get(base_url).content)
+    title = "Programa_de_Introdução_ao_Jornalismo_Científico"
+
+    try:
+        cache_key = wikiversity_pdf_cache_key(title, get_latest_revids([title])[title])
+    except (requests.RequestException, ValueError, KeyError) as error:
+        app.logger.warning('Could not query the latest revisions: %s', error)
+        cache_key = None
+
+    file = wikiversity_pdf_cache.open(cache_key) if cache_key else None
+    if file:
+        return send_file(file, mimetype='application/pdf', as_attachment=True, download_name='IJC_Programa.pdf')
+
+    # Stream the page from the REST API to the user, storing it in the cache on the way
+    with span('upstream'):
+        upstream = wikiversity.get(WIKIVERSITY_URL + "/api/rest_v1/page/pdf/" + title,
+                                   stream=True, timeout=app.config.get('WIKIVERSITY_PDF_TIMEOUT', 60))
+    if not upstream.ok:
+        upstream.close()
+        return 'Ocorreu um erro!', 502
+
+    chunks = upstream.iter_content(64 * 1024)
+    if cache_key:
+        # The older revisions of the page won't be served again
+        wikiversity_pdf_cache.discard(cache_key.split('_')[0] + '_*')
+        chunks = wikiversity_pdf_cache.put_stream(cache_key, chunks)
+
+    response = Response(chunks, mimetype='application/pdf')
     response.headers.set('Content-Disposition', 'attachment',
                          filename='IJC_Programa.pdf')
-    response.headers.set('Content-Type', 'application/pdf')
+    response.call_on_close(upstream.close)
     return response
 
 
@@ -465,205 +1286,293 @@ def generate_certificate():
 
     :return: A pdf file with the certificate
     """
-    username = get_username()
+    username = g.user
+    user = g.current_user
 
-    user = Users.query.filter_by(username=username).first()
     if username and user:
-        if user.can_download_certificate == ";".join(["T" for i in range(app.config["NUMBER_OF_MODULES"])]):
-            # Create page
-            pdf = CertificationPDF(orientation='L', unit='mm', format='A4')
-            pdf.add_page()
-            pdf.set_text_color(0, 46, 75)
-
-            #######################################################################################################
-            # Header
-            #######################################################################################################
-            pdf.set_y(20)                          # Start the letter text at the 10x42mm point
-
-            pdf.add_font('Merriweather', '', os.path.join(app.static_folder, 'fonts/Merriweather-Regular.ttf'), uni=True)
-            pdf.add_font('Merriweather-Bold', '', os.path.join(app.static_folder, 'fonts/Merriweather-Bold.ttf'), uni=True)
-            pdf.set_font('Merriweather', '', 37)               # Text of the body in Times New Roman, regular, 13 pt
-
-            locale.setlocale(locale.LC_TIME, "pt_BR")   # Setting the language to portuguese for the date
-            pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='CERTIFICADO')
-
-            pdf.set_font('Merriweather', '', 14.5)
-            pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='Concedemos este certificado a')
-            pdf.cell(w=0, h=10, ln=1)                  # New line
-
-            #######################################################################################################
-            # User name
-            #######################################################################################################
-            user = Users.query.filter_by(username=username).first()
-            name = user.full_name                                       # User full name
-            pdf.set_font('Merriweather', '', 35)
-            name_size = pdf.get_string_width(name)
-
-            if name_size > 287:
-                # Try to eliminate the prepositions
-                name_split = [name_part for name_part in name.split(' ') if not name_part.islower()]
-                # There's a first and last names and at least one middle name
-                if len(name_split) > 2:
-                    first_name = name_split[0]
-                    last_name = name_split[-1]
-                    middle_names = [md_name[0]+'.' for md_name in name_split[1:-1]]
-                    name = first_name + ' ' + ' '.join(middle_names) + ' ' + last_name
-                    name_size = pdf.get_string_width(name)
-
-                # Even abbreviating, there is still the possibility that the name is too big, so
-                # we need to adjust it to the proper size
-                if name_size > 287:
-                    pdf.set_font('Merriweather', '', math.floor(287 * 35 / name_size))
-
-            pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt=name)
-            pdf.cell(w=0, h=10, ln=1)  # New line
-
-            #######################################################################################################
-            # por ter completado as leituras e as 6 tarefas do curso online
-            #######################################################################################################
-            pdf.set_font('Merriweather', '', 14.5)
-            pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='por ter completado as leituras e as ' +
-                                                               str(app.config["NUMBER_OF_MODULES"]) +
-                                                               ' tarefas do curso online')
-
-            #######################################################################################################
-            # Introdução ao Jornalismo Científico
-            #######################################################################################################
-            pdf.set_font('Merriweather-Bold', '', 21)
-            pdf.cell(w=0, h=10, border=0, ln=1, align='C', txt='Introdução ao Jornalismo Científico')
-            pdf.cell(w=0, h=8, ln=1)  # New line
-
-            #######################################################################################################
-            # Logo NeuroMat
-            #######################################################################################################
-            pdf.set_font('Merriweather', '', 12.5)
-            pdf.set_x(50)
-            y_production = pdf.get_y()
-            pdf.cell(w=20, h=10, border=0, ln=0, align='L', txt='Produção:')
-            y_logos = pdf.get_y()
-            pdf.image(os.path.join(app.static_folder, 'neuromat.png'), x=78, y=y_production+0.6, h=8.5)
-
-            #######################################################################################################
-            # Logo FAPESP and WMB
-            #######################################################################################################
-            pdf.set_xy(155, y_production)
-            pdf.cell(w=20, h=10, border=0, ln=1, align='L', txt='Apoio:')
-            pdf.image(os.path.join(app.static_folder, 'fapesp.png'), x=175, y=y_production+1.1, h=7)
-            pdf.image(os.path.join(app.static_folder, 'wmb.png'), x=215, y=y_production-1.1, h=13)
-
-            pdf.cell(w=0, h=5, ln=1)  # New line
-
-            #######################################################################################################
-            # Footer
-            #######################################################################################################
-            y_signature = pdf.get_y()                   # Register the "y" position, so the signatures are aligned
-
-            # Fernando da Paixão signature
-            pdf.image(os.path.join(app.static_folder, 'fpaixao.png'), x=75, y=y_signature, w=35, h=16)
-            pdf.set_xy(50, y_signature+6)
-            pdf.multi_cell(w=90,
-                           h=6.5,
-                           txt="______________________\n"
-                               "FERNANDO JORGE DA\nPAIXÃO FILHO\n\nCoordenador da equipe de\ndifusão do CEPID NeuroMat",
-                           border=0,
-                           align='C')
-
-            # João Alexandre Peschanski signature
-            pdf.image(os.path.join(app.static_folder, 'jap.png'), x=180, y=y_signature+2, w=35, h=16)
-            pdf.set_xy(155, y_signature+6)
-            pdf.multi_cell(w=90,
-                           h=6.5,
-                           txt="______________________\n"
-                               "JOÃO ALEXANDRE\nPESCHANSKI\n\nPesquisador associado\ndo CEPID NeuroMat",
-                           border=0,
-                           align='C')
-            pdf.cell(w=0, h=10, ln=1)  # New line
-            pdf.set_font('Merriweather', '', 10.5)
-
-            # Text
-            pdf.set_x(25)
-            pdf.multi_cell(w=247, h=10, border=0, align='C', txt='O curso de Introdução ao Jornalismo Científico não tem um '
-                                                                 'controle de registros, as leituras e tarefas são de acesso '
-                                                                 'livre. Este certificado, portanto, não é reconhecido como '
-                                                                 'um diploma oficial. O curso totaliza para sua realização '
-                                                                 'noventa horas.')
-
-            # Generate the file
-            file = pdf.output(dest='S').encode('latin-1')
-
-            response = make_response(file)
-            response.headers.set('Content-Disposition', 'attachment',
-                                 filename='IJC_Certificado_' + name.replace(" ", "_") + '.pdf')
-            response.headers.set('Content-Type', 'application/pdf')
-            return response
+        if user.completed:
+            return cached_pdf_response('certificate_' + user.certificate_code,
+                                       lambda: certificate_pdf(user.full_name, user.certificate_code),
+                                       'attachment',
+                                       'IJC_Certificado_' + user.full_name.replace(" ", "_") + '.pdf')
         else:
             return redirect(url_for('certificate'))
     else:
         return redirect(url_for('home'))
 
 
+# Gerar os certificados de todos que concluíram o curso
+@app.route('/certificates', methods=['GET'])
+def bulk_certificates():
+    """
+    This function generates the certificates of all users who completed the course, or
+    of those whose username starts with the prefix parameter or is in the user
+    parameters, for the coordinators. The zip file is streamed while the certificates are
+    generated, the single pdf file is sent once all of them were merged. They are generated
+    one by one in the web worker, the issue-certificates command uses more processes.
+
+    :return: A zip file with a pdf file for each user, or a single pdf file with format=pdf
+    """
+    if g.user not in app.config['COORDINATORS_USERNAMES']:
+        return redirect(url_for('certificate'))
+
+    users = completed_users(request.args.get('prefix', '').strip(), request.args.getlist('user'))
+    if not users:
+        return 'Nenhum certificado a gerar', 404
+    files = issue_certificates([(full_name, certificate_code) for username, full_name, certificate_code in users])
+
+    if request.args.get('format') == 'pdf':
+        with span('pdf'):
+            file = merged_pdf(files)
+        return send_file(file, mimetype='application/pdf', as_attachment=True, download_name='IJC_Certificados.pdf')
+
+    response = Response(zip_stream((certificates_filename(username), file) for (username, _, _), file in zip(users, files)),
+                        mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename='IJC_Certificados.zip')
+    return response
+
+
 # Gerar anexos
 @app.route('/generate_attachment', methods=['GET'])
 def generate_attachment():
-    username = get_username()
+    user = g.current_user
 
-    base_url = "https://pt.wikiversity.org/api/rest_v1/page/pdf/"
-    prefix_course = 'Introdução_ao_Jornalismo_Científico%2F'
-    pages = ["Metodologia_e_Filosofia_da_Ciência%2FAtividade%2F",
-             "História_da_Ciência_e_da_Tecnologia%2FAtividade%2F",
-             "Ética_da_Ciência%2FAtividade%2F",
-             "Temas_Centrais_da_Ciência_Contemporânea%2FAtividade%2F",
-             "Modos_de_Organização_e_Financiamento_dos_Sistemas_de_Pesquisa,_no_Brasil_e_no_Exterior%2FAtividade%2F",
-             "Mídias,_Linguagens_e_Prática_do_Jornalismo_Científico%2FAtividade%2F"]
+    if user and user.completed:
+        file, failed_modules = attachment_pdf(user.username)
 
-    user = Users.query.filter_by(username=username).first()
+        if failed_modules:
+            return 'Ocorreu um erro ao obter as atividades do(s) módulo(s) ' + ', '.join(failed_modules) + '!', 502
 
-    if user and user.can_download_certificate == ";".join(["T" for i in range(app.config["NUMBER_OF_MODULES"])]):
-        try:
-            responses = []
-            for page in pages:
-                responses.append(PyPDF2.PdfFileReader(io.BytesIO(requests.get(base_url + prefix_course + page + user.username).content)))
-            output = io.BytesIO()
-            writer = PyPDF2.PdfFileWriter()
-            for response in responses:
-                n = response.getNumPages()
-                for i in range(n):
-                    writer.addPage(response.getPage(i))
-
-            writer.write(output)
-            result = Response(output.getvalue(), mimetype="application/pdf")
-            result.headers.set('Content-Disposition', 'attachment',
-                               filename='IJC_Anexos_' + user.full_name.replace(' ', '_') + '.pdf')
-            result.headers.set('Content-Type', 'application/pdf')
-            return result
-        except:
-            return redirect(url_for('certificate'))
+        return send_file(file, mimetype='application/pdf', as_attachment=True,
+                         download_name='IJC_Anexos_' + user.full_name.replace(' ', '_') + '.pdf')
     else:
         return redirect(url_for('certificate'))
 
 
+def attachment_pdf(username):
+    """
+    Merges the activities of all modules of a user, as rendered by the Wikimedia REST API,
+    in a single pdf file
+
+    :param username: the username of the user
+    :return: the pdf file, as a temporary file opened for reading, and the list of modules
+    whose activities could not be fetched. If any module failed, the file is None
+    """
+    files = fetch_wikiversity_pdfs([title + username for title in MODULES_ACTIVITIES_TITLES])
+
+    responses = []
+    failed_modules = []
+    for module, file in enumerate(files, 1):
+        try:
+            if isinstance(file, Exception):
+                raise file
+            responses.append(PdfFileReader(io.BytesIO(file)))
+        except Exception as error:
+            app.logger.warning('Could not fetch the activity of module %s of %s: %s', module, username, error)
+            failed_modules.append(str(module))
+
+    if failed_modules:
+        return None, failed_modules
+
+    # Kept in memory while small, written to disk past that, and sent without being copied
+    output = tempfile.SpooledTemporaryFile(max_size=app.config.get('ATTACHMENT_SPOOL_SIZE', 5 * 1024 * 1024))
+    with span('pdf'):
+        writer = PdfFileWriter()
+        for response in responses:
+            n = response.getNumPages()
+            for i in range(n):
+                writer.addPage(response.getPage(i))
+
+        writer.write(output)
+    output.seek(0)
+    return output, []
+
+
+def fetch_wikiversity_pdfs(titles):
+    """
+    Gets pages of Wikiversity rendered as pdf by the Wikimedia REST API. A single query
+    asks for the latest revision of all pages, and only the pages edited since they were
+    cached are downloaded again, all at the same time.
+
+    :param titles: the titles of the pages
+    :return: for each page, the pdf file as bytes or the exception raised fetching it
+    """
+    try:
+        revids = get_latest_revids(titles)
+    except (requests.RequestException, ValueError, KeyError) as error:
+        # Without the revisions the pages can't be checked against the cache
+        app.logger.warning('Could not query the latest revisions: %s', error)
+        revids = {}
+
+    files = {}
+    fetches = {}
+    for title in titles:
+        cache_key = None
+        if revids.get(title):
+            cache_key = wikiversity_pdf_cache_key(title, revids[title])
+            files[title] = wikiversity_pdf_cache.get(cache_key)
+        if files.get(title) is None:
+            fetches[title] = cache_key, wikiversity_pdf_fetcher.submit(fetch_wikiversity_pdf, title)
+
+    for title, (cache_key, fetch) in fetches.items():
+        try:
+            with span('upstream'):
+                files[title] = fetch.result()
+            if cache_key:
+                # The older revisions of the page won't be served again
+                wikiversity_pdf_cache.discard(cache_key.split('_')[0] + '_*')
+                wikiversity_pdf_cache.put(cache_key, files[title])
+        except Exception as error:
+            files[title] = error
+    return [files[title] for title in titles]
+
+
+def wikiversity_pdf_cache_key(title, revid):
+    """
+    :return: the key of a revision of a page in the cache, or None if the page doesn't exist
+    """
+    if not revid:
+        return None
+    return hashlib.sha1(bytes(title, 'utf-8')).hexdigest() + '_' + str(revid)
+
+
+def fetch_wikiversity_pdf(title):
+    """
+    Downloads a page rendered as pdf by the Wikimedia REST API
+
+    :param title: the title of the page
+    :return: the pdf file, as bytes
+    """
+    base_url = WIKIVERSITY_URL + "/api/rest_v1/page/pdf/"
+    response = wikiversity.get(base_url + title.replace('/', '%2F'), timeout=app.config.get('WIKIVERSITY_PDF_TIMEOUT', 60))
+    response.raise_for_status()
+    return response.content
+
+
+def get_activity_content(title, revid):
+    """
+    Gets the wikitext of a revision of a page, from the cache if it was read before
+
+    :param title: the title of the page
+    :param revid: the id of the revision
+    :return: the wikitext of the revision
+    """
+    cache_key = wikiversity_pdf_cache_key(title, revid)
+    content = activity_cache.get(cache_key)
+    if content is not None:
+        return content.decode('utf-8')
+
+    with span('api'):
+        data = wikiversity.get(WIKIVERSITY_URL + '/w/api.php',
+                               params={'action': 'query', 'prop': 'revisions', 'rvprop': 'content', 'rvslots': 'main',
+                                       'revids': revid, 'format': 'json'},
+                               timeout=app.config.get('WIKIVERSITY_API_TIMEOUT', 10)).json()
+    content = next(iter(get_content(data).values()), '')
+    # The older revisions of the page won't be seen again
+    activity_cache.discard(cache_key.split('_')[0] + '_*')
+    activity_cache.put(cache_key, content.encode('utf-8'))
+    return content
+
+
+def get_latest_revids(titles):
+    """
+    Queries the id of the latest revision of pages of Wikiversity
+
+    :param titles: the titles of the pages
+    :return: a dictionary with the revision id of each title, None if the page doesn't exist
+    """
+    return {title: revision['revid'] if revision else None
+            for title, revision in get_latest_revisions(titles).items()}
+
+
+# Latest revision of the pages shown to the coordinators, with the time it was queried, in
+# the order they were queried, so the expired ones are at the start
+latest_revisions_cache = {}
+latest_revisions_lock = threading.Lock()
+
+
+def get_latest_revisions(titles, max_age=0):
+    """
+    Queries the latest revision of pages of Wikiversity, up to 50 pages per request
+
+    :param titles: the titles of the pages
+    :param max_age: for how many seconds the revisions queried before are used instead of
+    querying them again, 0 to always query them
+    :return: a dictionary with the latest revision of each title, with its revid, size and
+    timestamp, or None if the page doesn't exist
+    """
+    now = time.time()
+    revisions = {}
+    if max_age:
+        for title in titles:
+            queried_at, revision = latest_revisions_cache.get(title, (0, None))
+            if now - queried_at <= max_age:
+                revisions[title] = revision
+    outdated = [title for title in titles if title not in revisions]
+
+    for data in query_revisions(outdated, 'ids|size|timestamp'):
+        normalized = {item['from']: item['to'] for item in data['query'].get('normalized', [])}
+        replied = get_revision_ids(data)
+        for title in outdated:
+            if normalized.get(title, title) in replied:
+                revisions[title] = replied[normalized.get(title, title)]
+
+    for title in outdated:
+        revisions.setdefault(title, None)
+    if max_age:
+        max_size = app.config.get('REVIEW_REVISIONS_CACHE_SIZE', 10000)
+        with latest_revisions_lock:
+            for title in outdated:
+                latest_revisions_cache.pop(title, None)
+                latest_revisions_cache[title] = now, revisions[title]
+            while latest_revisions_cache:
+                oldest = next(iter(latest_revisions_cache))
+                if now - latest_revisions_cache[oldest][0] <= max_age and len(latest_revisions_cache) <= max_size:
+                    break
+                del latest_revisions_cache[oldest]
+    return revisions
+
+
+def query_revisions(titles, rvprop):
+    """
+    Queries the latest revision of pages of Wikiversity, up to 50 pages per request, the
+    limit of the API, and following the continuations of the API
+
+    :param titles: the titles of the pages
+    :param rvprop: the properties of the revisions, separated by |
+    :return: the replies of the API, in formatversion 2
+    """
+    for i in range(0, len(titles), 50):
+        params = {'action': 'query', 'prop': 'revisions', 'rvprop': rvprop, 'titles': '|'.join(titles[i:i + 50]),
+                  'format': 'json', 'formatversion': 2, 'continue': ''}
+        while True:
+            with span('api'):
+                data = wikiversity.get(WIKIVERSITY_URL + '/w/api.php', params=params,
+                                       timeout=app.config.get('WIKIVERSITY_API_TIMEOUT', 10)).json()
+            yield data
+            if 'continue' not in data:
+                break
+            params = dict(params, **data['continue'])
+
+
 # Gerenciar atividades
 @app.route('/certificate', methods=['GET'])
 def certificate():
-    username = get_username()
+    username = g.user
 
     if request.method == 'GET':
         if username in app.config['COORDINATORS_USERNAMES']:
-            users = Users.query.all()
-            return render_template('certificate.html',
-                                   username=username,
-                                   users=users,
-                                   coordinator=True)
+            return coordinator_dashboard(username)
         else:
-            users = Users.query.filter_by(username=username)
-
-            if users.first():
-                can_download_certificate = all(x == "T" for x in users.first().can_download_certificate.split(";"))
+            if g.current_user:
+                users = [g.current_user]
+                can_download_certificate = g.current_user.completed
             else:
                 return redirect(url_for('subscription'))
             return render_template('certificate.html',
                                    username=username,
                                    users=users,
+                                   aulas=MODULES_ACTIVITIES_URLS,
                                    can_download_certificate=can_download_certificate)
     else:
         return redirect(url_for('home'))
@@ -672,35 +1581,91 @@ def certificate():
 # Gerenciar atividades
 @app.route('/certificate/requested', methods=['GET'])
 def certificate_only_requested():
-    username = get_username()
+    username = g.user
 
     if username in app.config['COORDINATORS_USERNAMES']:
         if request.method == 'GET':
-            users = Users.query.filter_by(solicited_certificate=True)
-            return render_template('certificate.html',
-                                   username=username,
-                                   users=users,
-                                   coordinator=True)
+            return coordinator_dashboard(username, status='requested')
     else:
         return redirect(url_for('certificate'))
 
 
+def coordinator_dashboard(username, status=''):
+    """
+    This function renders one page of the students table for the coordinators. The
+    students can be filtered by status and username prefix and sorted through the
+    query string, and only the requested page is loaded from the database.
+
+    :param username: the username of the coordinator
+    :param status: the status filter used when none is given in the query string
+    :return: A html page with the students table
+    """
+    filters = {'status': request.args.get('status', status),
+               'module': request.args.get('module', ''),
+               'prefix': request.args.get('prefix', '').strip(),
+               'sort': request.args.get('sort', 'username'),
+               'order': request.args.get('order', 'asc')}
+
+    # The approved and pending filters apply to a single module when one is chosen
+    module_filter = ModuleStatus.status != "T"
+    if filters['module'].isdigit():
+        module_filter = db.and_(module_filter, ModuleStatus.module == int(filters['module']))
+
+    query = Users.query.options(db.undefer(Users.full_name))
+    if filters['status'] == 'requested':
+        query = query.filter(Users.solicited_certificate.is_(True))
+    elif filters['status'] == 'approved':
+        query = query.filter(~Users.modules.any(module_filter) if filters['module'].isdigit() else Users.completed.is_(True))
+    elif filters['status'] == 'pending':
+        query = query.filter(Users.modules.any(module_filter) if filters['module'].isdigit() else Users.completed.is_(False))
+    if filters['prefix']:
+        query = query.filter(Users.username.startswith(filters['prefix'], autoescape=True))
+
+    sort_column = DASHBOARD_SORTING.get(filters['sort'], Users.username)
+    if filters['order'] == 'desc':
+        query = query.order_by(sort_column.desc(), Users.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), Users.id.asc())
+
+    per_page = request.args.get('per_page', app.config.get('USERS_PER_PAGE', 50), type=int)
+    users = query.paginate(per_page=per_page, max_per_page=500, error_out=False)
+
+    return render_template('certificate.html',
+                           username=username,
+                           users=users,
+                           aulas=MODULES_ACTIVITIES_URLS,
+                           filters=filters,
+                           modules_counts=count_modules_status(),
+                           summary=completion_summary(),
+                           coordinator=True)
+
+
+def count_modules_status():
+    """
+    :return: a dictionary with the number of activities in each status, for each module
+    """
+    modules_counts = {module: {"T": 0, "F": 0, "NP": 0, "S": 0} for module in range(1, app.config["NUMBER_OF_MODULES"] + 1)}
+    for module, module_status, count in db.session.query(ModuleStatus.module, ModuleStatus.status, db.func.count())\
+            .group_by(ModuleStatus.module, ModuleStatus.status):
+        modules_counts.setdefault(module, {})[module_status] = count
+    return modules_counts
+
+
 # Solicitar certificado
 @app.route('/solicit_certificate', methods=['GET'])
 def solicit_certificate():
-    username = get_username()
-
-    user_soliciting = Users.query.filter_by(username=username).first()
-    if username and user_soliciting and user_soliciting.can_download_certificate != "T;T;T;T;T;T" and not user_soliciting.solicited_certificate:
-        user_soliciting.solicited_certificate = True
+    username = g.user
+    user_soliciting = g.current_user
 
-        status_activities = ";".join(
-            ["NP" if x == "F" else x for x in user_soliciting.can_download_certificate.split(";")])
-        user_soliciting.can_download_certificate = status_activities
+    if username and user_soliciting and not user_soliciting.completed and not user_soliciting.solicited_certificate:
+        def changes():
+            # Of simultaneous requests, only the first one changes the status and emails the coordinators
+            if update_solicited_certificate(user_soliciting.id, True, current=False):
+                update_modules_status(user_soliciting.id, "NP", current_status="F")
+                ask_coordinator_for_certificate_email(username, user_soliciting.full_name)
 
         try:
-            db.session.commit()
-            ask_coordinator_for_certificate_email(user_soliciting.username, user_soliciting.full_name)
+            commit_or_retry(changes)
             return redirect(url_for('certificate'))
         except:
             return 'Ocorreu um erro!'
@@ -711,14 +1676,13 @@ def solicit_certificate():
 # Rejeitar pedido de certificação (atividades pendentes)
 @app.route('/deny_solicitation/<user_username>', methods=['GET'])
 def deny_solicitation_for_certificate(user_username):
-    username = get_username()
+    username = g.user
 
     if username in app.config['COORDINATORS_USERNAMES']:
-        user_denied = Users.query.filter_by(username=user_username).first()
+        user_denied = db.session.query(Users.id).filter_by(username=user_username).scalar()
         if user_username and user_denied:
-            user_denied.solicited_certificate = False
             try:
-                db.session.commit()
+                commit_or_retry(lambda: update_solicited_certificate(user_denied, False))
                 return redirect(url_for('certificate'))
             except:
                 return 'Ocorreu um erro!'
@@ -729,15 +1693,17 @@ def deny_solicitation_for_certificate(user_username):
 # Aprovar certificação sem pedido
 @app.route('/approve_certification_without_request/<user_username>', methods=['GET'])
 def approve_certification_without_request(user_username):
-    username = get_username()
+    username = g.user
 
     if username in app.config['COORDINATORS_USERNAMES']:
-        user_approved = Users.query.filter_by(username=user_username).first()
+        user_approved = db.session.query(Users.id).filter_by(username=user_username).scalar()
         if user_username and user_approved:
-            user_approved.solicited_certificate = True
-            user_approved.can_download_certificate = ";".join(["T" for i in range(app.config["NUMBER_OF_MODULES"])])
+            def changes():
+                update_solicited_certificate(user_approved, True)
+                update_modules_status(user_approved, "T")
+
             try:
-                db.session.commit()
+                commit_or_retry(changes)
                 return redirect(url_for('certificate'))
             except:
                 return 'Ocorreu um erro!'
@@ -748,16 +1714,13 @@ def approve_certification_without_request(user_username):
 # Aprovar uma atividade
 @app.route('/approve_certification/<user>/<module_activity>', methods=['GET'])
 def approve_certification(user, module_activity):
-    username = get_username()
+    username = g.user
 
     if username in app.config['COORDINATORS_USERNAMES'] and int(module_activity) >= 1:
-        user_to_be_approved = Users.query.filter_by(username=user).first()
+        user_to_be_approved = db.session.query(Users.id).filter_by(username=user).scalar()
 
-        user_modules_activities = user_to_be_approved.can_download_certificate.split(";")
-        user_modules_activities[int(module_activity)-1] = "T"
-        user_to_be_approved.can_download_certificate = ";".join(user_modules_activities)
         try:
-            db.session.commit()
+            commit_or_retry(lambda: update_modules_status(user_to_be_approved, "T", module=int(module_activity)))
             return redirect(url_for('certificate'))
         except:
             return 'Ocorreu um erro!'
@@ -768,16 +1731,13 @@ def approve_certification(user, module_activity):
 # Rejeitar uma atividade
 @app.route('/deny_certification/<user>/<module_activity>', methods=['GET'])
 def deny_certification(user, module_activity):
-    username = get_username()
+    username = g.user
 
     if username in app.config['COORDINATORS_USERNAMES']:
-        user_to_be_approved = Users.query.filter_by(username=user).first()
+        user_to_be_approved = db.session.query(Users.id).filter_by(username=user).scalar()
 
-        user_modules_activities = user_to_be_approved.can_download_certificate.split(";")
-        user_modules_activities[int(module_activity)-1] = "F"
-        user_to_be_approved.can_download_certificate = ";".join(user_modules_activities)
         try:
-            db.session.commit()
+            commit_or_retry(lambda: update_modules_status(user_to_be_approved, "F", module=int(module_activity)))
             return redirect(url_for('certificate'))
         except:
             return 'Ocorreu um erro!'
@@ -785,16 +1745,323 @@ def deny_certification(user, module_activity):
         return redirect(url_for('certificate'))
 
 
+# Aprovar ou rejeitar várias atividades
+@app.route('/certification/decisions', methods=['POST'])
+def decide_certifications():
+    """
+    This function applies many decisions of a coordinator at once, in a single transaction
+    with one UPDATE statement per status. The body is a json such as
+    {"decisions": [{"user": "Username", "module": 1, "status": "T"}, ...]}, where the
+    status is "T" to approve the activity and "F" to deny it. If any decision is invalid,
+    none is applied.
+
+    :return: A json with the number of modules updated, the status of all modules of the
+    users decided on, the number of activities in each status, for each module, and the
+    number of users who completed the course and who await review
+    """
+    if g.user not in app.config['COORDINATORS_USERNAMES']:
+        return jsonify(error='Acesso negado'), 403
+
+    decisions = (request.get_json(silent=True) or {}).get('decisions')
+    if not isinstance(decisions, list) or not decisions:
+        return jsonify(error='Nenhuma decisão enviada'), 400
+
+    valid = [isinstance(decision, dict) and isinstance(decision.get('user'), str)
+             and decision.get('status') in ("T", "F")
+             and type(decision.get('module')) is int and 1 <= decision['module'] <= app.config["NUMBER_OF_MODULES"]
+             for decision in decisions]
+    users_ids = dict(db.session.query(Users.username, Users.id).filter(
+        Users.username.in_({decision['user'] for i, decision in enumerate(decisions) if valid[i]})))
+    invalid = [i for i, decision in enumerate(decisions) if not valid[i] or decision['user'] not in users_ids]
+    if invalid:
+        return jsonify(error='Decisões inválidas', invalid=invalid), 400
+
+    # The last decision on the same activity prevails
+    statuses = {(users_ids[decision['user']], decision['module']): decision['status'] for decision in decisions}
+
+    def changes():
+        updated = 0
+        for status in ("T", "F"):
+            activities = [activity for activity, activity_status in statuses.items() if activity_status == status]
+            for i in range(0, len(activities), 500):
+                updated += db.session.execute(
+                    db.update(ModuleStatus)
+                    .where(db.tuple_(ModuleStatus.user_id, ModuleStatus.module).in_(activities[i:i + 500]))
+                    .values(status=status, updated_at=datetime.utcnow())).rowcount
+        update_modules_counters(list(users_ids.values()))
+        return updated
+
+    try:
+        updated = commit_or_retry(changes)
+    except:
+        db.session.rollback()
+        return jsonify(error='Ocorreu um erro!'), 500
+
+    users = {}
+    for user, module_status in db.session.query(Users.username, ModuleStatus.status).join(Users.modules)\
+            .filter(Users.id.in_(users_ids.values())).order_by(Users.username, ModuleStatus.module):
+        users.setdefault(user, []).append(module_status)
+
+    return jsonify(updated=updated, users=users, modules_counts=count_modules_status(), summary=completion_summary())
+
+
+@app.route('/certification/revisions', methods=['GET'])
+def activities_revisions():
+    """
+    This function queries the latest revision of the activity pages of the students
+    shown to a coordinator, for many students at once, with up to 50 pages per request
+    to the API of Wikiversity. The revisions are kept for REVIEW_REVISIONS_MAX_AGE
+    seconds, so reloading the students table doesn't query them again.
+
+    :return: A json with, for each username given in the user parameters, a list with the
+    latest revision of the activity of each module, or the link to create it if it doesn't exist
+    """
+    if g.user not in app.config['COORDINATORS_USERNAMES']:
+        return jsonify(error='Acesso negado'), 403
+
+    usernames = request.args.getlist('user')[:500]
+    titles = {(username, module): title + username.replace(' ', '_')
+              for username in usernames for module, title in enumerate(MODULES_ACTIVITIES_TITLES, 1)}
+    try:
+        revisions = get_latest_revisions(list(titles.values()), max_age=app.config.get('REVIEW_REVISIONS_MAX_AGE', 300))
+    except (requests.RequestException, ValueError, KeyError):
+        return jsonify(error='Não foi possível consultar a Wikiversidade'), 502
+
+    users = {}
+    for (username, module), title in titles.items():
+        revision = revisions[title]
+        if revision:
+            activity = {'exists': True, 'revid': revision['revid'], 'size': revision['size'],
+                        'timestamp': revision['timestamp'],
+                        'url': WIKIVERSITY_URL + '/w/index.php?' + urlencode({'title': title, 'oldid': revision['revid']})}
+        else:
+            activity = {'exists': False,
+                        'url': WIKIVERSITY_URL + '/w/index.php?' + urlencode({'title': title, 'action': 'edit',
+                                                                               'redlink': 1})}
+        users.setdefault(username, []).append(activity)
+    return jsonify(users=users)
+
+
+@app.route('/activity/<user>/<int:module>', methods=['GET'])
+def activity(user, module):
+    """
+    This function shows the activity of a user in a module, as written in the latest
+    revision of its page, to the coordinators and to the user. The latest revid is kept
+    for REVIEW_REVISIONS_MAX_AGE seconds and the wikitext of each revision in the
+    activity cache, so seeing the same revision again doesn't call the API of Wikiversity.
+    The revid is the ETag of the page, so the browsers revalidate their copy of it.
+
+    :param user: the username of the user
+    :param module: the number of the module
+    :return: A html page with the activity
+    """
+    username = g.user
+    if username not in app.config['COORDINATORS_USERNAMES'] and username != user:
+        return redirect(url_for('certificate'))
+    if not 1 <= module <= len(MODULES_ACTIVITIES_TITLES):
+        return 'Módulo inexistente', 404
+
+    title = MODULES_ACTIVITIES_TITLES[module - 1] + user.replace(' ', '_')
+    try:
+        revision = get_latest_revisions([title], max_age=app.config.get('REVIEW_REVISIONS_MAX_AGE', 300))[title]
+        content = get_activity_content(title, revision['revid']) if revision else None
+    except (requests.RequestException, ValueError, KeyError) as error:
+        app.logger.warning('Could not get the activity: %s', error)
+        return 'Não foi possível consultar a Wikiversidade', 502
+
+    page_title = title.replace('_', ' ')
+    url = WIKIVERSITY_URL + '/w/index.php?' + urlencode({'title': title, 'oldid': revision['revid']} if revision else
+                                                        {'title': title, 'action': 'edit', 'redlink': 1})
+    response = make_response(render_template('atividades.html',
+                                             username=username,
+                                             title=page_title,
+                                             content={page_title: content},
+                                             revision=revision,
+                                             url=url))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.set_etag(str(revision['revid']) if revision else 'missing')
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+########################################################################################################################
+# J O B S
+########################################################################################################################
+# Documents that can be generated in the background, with the name of their files
+JOB_KINDS = {'certificate': 'IJC_Certificado_',
+             'attachment': 'IJC_Anexos_'}
+
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def submit_job(kind):
+    """
+    This function queues the generation of a document of the logged user, to be done by
+    the background workers. If the same document is already queued, that job is returned.
+
+    :return: A json with the id and status of the job and the urls to follow it
+    """
+    username = g.user
+    user = g.current_user
+
+    if kind not in JOB_KINDS or not user:
+        return jsonify(error='Documento inválido'), 404
+    if not user.completed:
+        return jsonify(error='As atividades ainda não foram aprovadas'), 403
+
+    def pending_job():
+        return Job.query.filter(Job.kind == kind, Job.username == username, Job.status.in_(["queued", "running"])).first()
+
+    job = pending_job()
+    if not job:
+        job = Job(kind=kind, username=username)
+        try:
+            db.session.add(job)
+            db.session.commit()
+        except IntegrityError:
+            # Another request queued the same document in the meantime
+            db.session.rollback()
+            job = pending_job()
+            if not job:
+                return jsonify(error='Ocorreu um erro!'), 409
+    return jsonify(job_status(job)), 202
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status_page(job_id):
+    """
+    This function reports the status of a job of the logged user
+
+    :return: A json with the id and status of the job and the urls to follow it
+    """
+    job = db.session.get(Job, job_id)
+    if not job or job.username != g.user:
+        return jsonify(error='Tarefa não encontrada'), 404
+    return jsonify(job_status(job))
+
+
+@app.route('/jobs/<int:job_id>/download', methods=['GET'])
+def download_job(job_id):
+    """
+    This function sends the document generated by a finished job of the logged user
+
+    :return: A pdf file with the document
+    """
+    job = db.session.get(Job, job_id)
+    if not job or job.username != g.user or job.status != "done" or not g.current_user:
+        return redirect(url_for('certificate'))
+
+    file = document_cache.get(job.artifact_key)
+    if file is None:
+        return 'O documento expirou, por favor, gere-o novamente.', 410
+
+    response = make_response(file)
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=JOB_KINDS[job.kind] + g.current_user.full_name.replace(" ", "_") + '.pdf')
+    response.headers.set('Content-Type', 'application/pdf')
+    return response
+
+
+def job_status(job):
+    status = {'id': job.id,
+              'kind': job.kind,
+              'status': job.status,
+              'status_url': url_for('job_status_page', job_id=job.id)}
+    if job.status == "done":
+        status['download_url'] = url_for('download_job', job_id=job.id)
+    if job.status == "failed":
+        status['error'] = job.error
+    return status
+
+
+def claim_job():
+    """
+    Marks the oldest queued job as running. The status is checked again by the UPDATE, so
+    two workers never claim the same job.
+
+    :return: the claimed job, or None if there are no queued jobs
+    """
+    while True:
+        job_id = db.session.query(Job.id).filter_by(status="queued").order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            return None
+        claimed = db.session.execute(db.update(Job)
+                                     .where(Job.id == job_id, Job.status == "queued")
+                                     .values(status="running", date_modified=datetime.utcnow())).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+
+
+def run_job(job):
+    """
+    Generates the document of a job and stores it in the documents cache
+
+    :param job: the job, already claimed by this worker
+    """
+    user = Users.query.options(db.undefer(Users.full_name)).filter_by(username=job.username).first()
+    try:
+        if job.kind == "certificate":
+            job.artifact_key = 'certificate_' + user.certificate_code
+            if job.artifact_key not in document_cache:
+                document_cache.put(job.artifact_key, certificate_pdf(user.full_name, user.certificate_code))
+        else:
+            file, failed_modules = attachment_pdf(user.username)
+            if failed_modules:
+                raise RuntimeError('Ocorreu um erro ao obter as atividades do(s) módulo(s) ' + ', '.join(failed_modules))
+            job.artifact_key = 'attachment_' + str(job.id)
+            with file:
+                document_cache.put_file(job.artifact_key, file)
+        job.status = "done"
+    except Exception as error:
+        app.logger.exception('Job %s failed', job.id)
+        job.status = "failed"
+        job.error = str(error)
+    db.session.commit()
+
+
+def purge_jobs(max_age):
+    """
+    Deletes the finished jobs older than max_age seconds, with the attachments they merged.
+    The certificates are kept, as they are the same documents served by /generate_certificate.
+
+    :param max_age: the age, in seconds, of the oldest finished jobs kept
+    :return: the number of jobs deleted
+    """
+    finished = db.and_(Job.status.in_(["done", "failed"]),
+                       Job.date_modified < datetime.utcnow() - timedelta(seconds=max_age))
+    for kind, artifact_key in db.session.query(Job.kind, Job.artifact_key).filter(finished):
+        if kind == "attachment" and artifact_key:
+            document_cache.discard(artifact_key)
+    deleted = db.session.execute(db.delete(Job).where(finished)).rowcount
+    db.session.commit()
+    return deleted
+
+
+def jobs_worker(poll_interval):
+    with app.app_context():
+        # Connections can't be shared with the parent process
+        db.engine.dispose(close=False)
+        while True:
+            job = claim_job()
+            if job:
+                run_job(job)
+            else:
+                time.sleep(poll_interval)
+
+
 def get_revision_ids(data):
+    """
+    :param data: a reply of the API to a query of the revisions of pages, in formatversion 2
+    :return: a dictionary with the latest revision of each page of the reply, None if the page
+    doesn't exist. The pages whose revision is left for a continuation aren't included
+    """
     return_list = {}
-    for elem in data['query']['pages']:
-        title = data['query']['pages'][elem]['title']
-        if 'revisions' in data['query']['pages'][elem]:
-            revid = str(data['query']['pages'][elem]['revisions'][0]['revid'])
-            link = 'https://pt.wikiversity.org/w/index.php?title='+title+'&oldid='+revid
-            return_list[title] = link, True
-        else:
-            return_list[title] = 'https://pt.wikiversity.org/w/index.php?title='+title+'&action=edit&redlink=1', False
+    for page in data['query']['pages']:
+        if 'revisions' in page:
+            return_list[page['title']] = dict(page['revisions'][0], exists=True)
+        elif page.get('missing') or page.get('invalid'):
+            return_list[page['title']] = None
     return return_list
 
 
@@ -803,37 +2070,503 @@ def get_content(data):
     for elem in data['query']['pages']:
         title = data['query']['pages'][elem]['title']
         if 'revisions' in data['query']['pages'][elem]:
-            content = str(data['query']['pages'][elem]['revisions'][0]['*'])
+            revision = data['query']['pages'][elem]['revisions'][0]
+            content = str(revision['slots']['main']['*'] if 'slots' in revision else revision['*'])
             return_list[title] = content
         else:
             return_list[title] = ''
     return return_list
 
 
+def activity_of_page(title):
+    """
+    :param title: the title of a page of Wikiversity, as given by the API
+    :return: the username and the module of the activity whose page it is, None if it
+    isn't the page of an activity
+    """
+    for module, prefix in enumerate(MODULES_ACTIVITIES_TITLES, 1):
+        prefix = prefix.replace('_', ' ')
+        if title.startswith(prefix) and title[len(prefix):] and '/' not in title[len(prefix):]:
+            return title[len(prefix):], module
+    return None
+
+
+def submit_activities(user_id, revids):
+    """
+    Marks activities of a user as submitted, unless they were already reviewed, and records
+    their revisions when they are newer than the ones recorded, with a single UPDATE
+    statement. It must be called in a transaction that updates the modules counters.
+
+    :param user_id: the id of the user
+    :param revids: a dictionary with the latest revid of each module
+    :return: the number of activities updated
+    """
+    submitted = db.case((ModuleStatus.status == "NP", "S"), else_=ModuleStatus.status)
+    revid = db.case(revids, value=ModuleStatus.module)
+    return db.session.execute(
+        db.update(ModuleStatus)
+        .where(ModuleStatus.user_id == user_id, ModuleStatus.module.in_(revids),
+               db.or_(ModuleStatus.revid.is_(None), ModuleStatus.revid < revid))
+        .values(status=submitted, revid=revid, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)).rowcount
+
+
+def submit_written_activities(user_id, username):
+    """
+    Queries the latest revision of the pages of the activities of a user who just subscribed,
+    and marks the activities whose pages exist as submitted. It is called after the user is
+    committed, so the changes made after the query are read by poll_recent_changes.
+
+    :param user_id: the id of the user
+    :param username: the username of the user
+    """
+    titles = [title + username.replace(' ', '_') for title in MODULES_ACTIVITIES_TITLES]
+    try:
+        revids = get_latest_revids(titles)
+    except (requests.RequestException, ValueError, KeyError) as error:
+        app.logger.warning('Could not query the activities written by %s: %s', username, error)
+        return
+
+    written = {module: revids[title] for module, title in enumerate(titles, 1) if revids[title]}
+    if not written:
+        return
+
+    def changes():
+        if submit_activities(user_id, written):
+            update_modules_counters([user_id])
+
+    commit_or_retry(changes)
+
+
+def poll_recent_changes():
+    """
+    Reads the changes of Wikiversity made after the "recentchanges" checkpoint, following
+    the continuations of the API, and marks the activities whose pages were created or
+    edited as submitted, recording their latest revision. The statuses and the checkpoint
+    are updated in the same transaction, so a change is never read twice.
+
+    :return: the number of activities updated
+    """
+    checkpoint = db.session.get(Checkpoint, 'recentchanges')
+    last = (checkpoint.last_id, checkpoint.timestamp) if checkpoint else (0, None)
+    params = {'action': 'query', 'list': 'recentchanges', 'rcnamespace': 0, 'rctype': 'edit|new',
+              'rcprop': 'ids|title|timestamp', 'rcdir': 'newer', 'rclimit': 500,
+              'format': 'json', 'formatversion': 2, 'continue': ''}
+    if checkpoint:
+        # The start is inclusive, the changes made in the same second are skipped by id
+        params['rcstart'] = checkpoint.timestamp
+
+    revids = {}
+    while True:
+        with span('api'):
+            data = wikiversity.get(WIKIVERSITY_URL + '/w/api.php', params=params,
+                                   timeout=app.config.get('WIKIVERSITY_API_TIMEOUT', 10)).json()
+        for change in data['query']['recentchanges']:
+            if checkpoint and change['rcid'] <= checkpoint.last_id:
+                continue
+            last = max(last, (change['rcid'], change['timestamp']), key=lambda item: item[0])
+            activity = activity_of_page(change['title'])
+            if activity:
+                revids[activity] = max(revids.get(activity, 0), change['revid'])
+        if 'continue' not in data:
+            break
+        params = dict(params, **data['continue'])
+
+    if last[1] is None:
+        return 0
+
+    users_ids = dict(db.session.query(Users.username, Users.id).filter(
+        Users.username.in_({username for username, module in revids})))
+    # The users who subscribe later get the activities they wrote before from
+    # submit_written_activities
+    users_revids = {}
+    for (username, module), revid in revids.items():
+        if username in users_ids:
+            users_revids.setdefault(users_ids[username], {})[module] = revid
+
+    def changes():
+        updated = sum(submit_activities(user_id, user_revids) for user_id, user_revids in users_revids.items())
+        if updated:
+            update_modules_counters(list(users_ids.values()))
+        db.session.merge(Checkpoint(name='recentchanges', last_id=last[0], timestamp=last[1]))
+        return updated
+
+    return commit_or_retry(changes)
+
+
 # Enviar email
 def ask_coordinator_for_certificate_email(username, fullname):
-    email_sender = app.config["GMAIL_EMAIL"]
-    email_password = app.config["GMAIL_PASSWORD"]
-    email_receiver = app.config["GMAIL_COORDINATOR_EMAIL"]
+    """
+    Queues the email asking the coordinators to evaluate the activities of a user. It is
+    added to the current transaction, and sent by the `flask --app app send-emails` process.
+
+    :param username: the username of the user
+    :param fullname: the full name of the user
+    """
+    db.session.add(OutboxEmail(username=username, full_name=fullname))
 
-    subject = "{fullname} ({username}) está solicitando um certificado do curso de Introdução ao Jornalismo Científico"
-    body = """Olá, {coordinator},<br><br>O(A) estudante {fullname}, cujo nome de usuário é {username} está solicitando que suas atividades do curso <b>Introdução ao Jornalismo Científico</b> sejam avaliadas e lhe seja garantido o certificado de conclusão do curso.<br><br>Você pode verificar este(a) e outros(as) estudantes com avaliações pendentes em {url}.<br><br><b>Introdução ao Jornalismo Científico</b><br>Solicitações de certificados | <a href="{url_home}">ijc.toolforge.org</a>"""
 
+def coordinators_email(subject, body, **fields):
+    """
+    :param subject: the subject of the email, formatted with the fields
+    :param body: the html body of the email, formatted with the fields and with the
+    coordinator, url and url_home fields
+    :return: the email addressed to the coordinators
+    """
     em = EmailMessage()
-    em["From"] = formataddr((str(Header(app.config["GMAIL_EMAIL_HEADER"], 'utf-8')), email_sender))
-    em["To"] = ", ".join(email_receiver)
-    em["Subject"] = subject.format(fullname=fullname, username=username)
-    formatted_body = body.format(fullname=fullname,
-                                 username=username,
-                                 url=url_for("certificate_only_requested", _external=True),
+    em["From"] = formataddr((str(Header(app.config["GMAIL_EMAIL_HEADER"], 'utf-8')), app.config["GMAIL_EMAIL"]))
+    em["To"] = ", ".join(app.config["GMAIL_COORDINATOR_EMAIL"])
+    em["Subject"] = subject.format(**fields)
+    formatted_body = body.format(url=url_for("certificate_only_requested", _external=True),
                                  url_home=url_for("home", _external=True),
-                                 coordinator=" e ".join([", ".join(app.config["COORDINATORS_USERNAMES"][:-1]), app.config["COORDINATORS_USERNAMES"][-1]]))
+                                 coordinator=" e ".join([", ".join(app.config["COORDINATORS_USERNAMES"][:-1]), app.config["COORDINATORS_USERNAMES"][-1]]),
+                                 **fields)
     em.set_content(MIMEText(formatted_body, "html"))
+    return em
+
+
+def certificate_request_email(username, fullname):
+    subject = "{fullname} ({username}) está solicitando um certificado do curso de Introdução ao Jornalismo Científico"
+    body = """Olá, {coordinator},<br><br>O(A) estudante {fullname}, cujo nome de usuário é {username} está solicitando que suas atividades do curso <b>Introdução ao Jornalismo Científico</b> sejam avaliadas e lhe seja garantido o certificado de conclusão do curso.<br><br>Você pode verificar este(a) e outros(as) estudantes com avaliações pendentes em {url}.<br><br><b>Introdução ao Jornalismo Científico</b><br>Solicitações de certificados | <a href="{url_home}">ijc.toolforge.org</a>"""
+
+    return coordinators_email(subject, body, fullname=fullname, username=username)
+
+
+def certificate_requests_digest_email(emails):
+    subject = "{count} estudantes estão solicitando certificados do curso de Introdução ao Jornalismo Científico"
+    body = """Olá, {coordinator},<br><br>Os(As) seguintes estudantes estão solicitando que suas atividades do curso <b>Introdução ao Jornalismo Científico</b> sejam avaliadas e lhes seja garantido o certificado de conclusão do curso:<ul>{students}</ul>Você pode verificar estes(as) e outros(as) estudantes com avaliações pendentes em {url}.<br><br><b>Introdução ao Jornalismo Científico</b><br>Solicitações de certificados | <a href="{url_home}">ijc.toolforge.org</a>"""
+
+    students = "".join("<li>{fullname} ({username})</li>".format(fullname=email.full_name, username=email.username)
+                       for email in emails)
+    return coordinators_email(subject, body, count=len(emails), students=students)
+
+
+def smtp_connection(smtp=None):
+    """
+    Checks that a connection to the SMTP server is still alive, opening a new one if it isn't
+
+    :param smtp: the connection in use, if any
+    :return: a connection ready to send emails
+    """
+    if smtp is not None:
+        try:
+            if smtp.noop()[0] == 250:
+                return smtp
+        except (smtplib.SMTPException, OSError):
+            pass
+        smtp.close()
+
+    if app.config.get('SMTP_SSL', True):
+        smtp = smtplib.SMTP_SSL(app.config.get('SMTP_HOST', 'smtp.gmail.com'), app.config.get('SMTP_PORT', 465),
+                                context=ssl.create_default_context(), timeout=30)
+    else:
+        smtp = smtplib.SMTP(app.config.get('SMTP_HOST', 'smtp.gmail.com'), app.config.get('SMTP_PORT', 465),
+                            timeout=30)
+    smtp.ehlo()
+    if smtp.has_extn('auth'):
+        smtp.login(app.config["GMAIL_EMAIL"], app.config["GMAIL_PASSWORD"])
+    return smtp
+
+
+def send_outbox(smtp):
+    """
+    Sends the queued emails through a connection to the SMTP server. When several emails
+    are queued and EMAIL_DIGEST is enabled, they are sent together in a single digest, and
+    if the digest is refused they are sent one by one. The emails refused by the server
+    OUTBOX_MAX_ATTEMPTS times are no longer sent, and keep the last error.
+
+    :param smtp: a function returning a connection ready to send emails, called only if
+    there is something to send
+    :return: the number of queued emails sent
+    """
+    emails = OutboxEmail.query.filter(OutboxEmail.date_sent.is_(None),
+                                      OutboxEmail.attempts < app.config.get('OUTBOX_MAX_ATTEMPTS', 5)) \
+        .order_by(OutboxEmail.id).all()
+    if not emails:
+        return 0
+
+    connection = smtp()
+
+    def send(message, queued_emails):
+        """
+        :return: the error of the server, None if the message was sent
+        """
+        try:
+            connection.sendmail(app.config["GMAIL_EMAIL"], app.config["GMAIL_COORDINATOR_EMAIL"], message.as_string())
+        except smtplib.SMTPServerDisconnected:
+            raise
+        except smtplib.SMTPException as error:
+            return str(error)
+        for email in queued_emails:
+            email.date_sent = datetime.utcnow()
+        db.session.commit()
+        return None
+
+    if app.config.get('EMAIL_DIGEST', True) and len(emails) > 1:
+        error = send(certificate_requests_digest_email(emails), emails)
+        if error is None:
+            return len(emails)
+        app.logger.warning('The digest was refused, sending the emails one by one: %s', error)
+
+    sent = 0
+    for email in emails:
+        error = send(certificate_request_email(email.username, email.full_name), [email])
+        if error is None:
+            sent += 1
+            continue
+        email.attempts += 1
+        email.error = error
+        db.session.commit()
+        app.logger.warning('Could not send the email of %s: %s', email.username, error)
+    return sent
+
+
+########################################################################################################################
+# C O M M A N D S
+########################################################################################################################
+@app.cli.command('init-db')
+def init_db():
+    """
+    Creates the tables and indexes missing from the database. Run it with
+    `flask --app app init-db`.
+    """
+    db.create_all()
+    # The tables created before an index was added don't get it from create_all
+    for index in Job.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    print('Database initialized')
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL('smtp.gmail.com', 465, context=context) as smtp:
-        smtp.login(email_sender, email_password)
-        smtp.sendmail(email_sender, email_receiver, em.as_string())
+
+@app.cli.command('run-jobs')
+@click.option('--workers', type=int, default=None, help='Number of worker processes')
+@click.option('--poll-interval', type=float, default=1.0, help='Seconds between checks for new jobs')
+def run_jobs(workers, poll_interval):
+    """
+    Starts the processes that generate the queued documents, so that the web workers
+    don't do the heavy pdf work, and deletes the jobs finished more than JOB_MAX_AGE
+    seconds ago every JOB_PURGE_INTERVAL seconds. Run it with `flask --app app run-jobs`.
+    """
+    workers = workers or app.config.get('JOB_WORKERS', 2)
+    max_age = app.config.get('JOB_MAX_AGE', 24 * 60 * 60)
+    purge_interval = app.config.get('JOB_PURGE_INTERVAL', 60 * 60)
+
+    # Jobs left running by workers that were stopped are queued again
+    db.session.execute(db.update(Job).where(Job.status == "running").values(status="queued"))
+    db.session.commit()
+    db.session.remove()
+
+    processes = [multiprocessing.Process(target=jobs_worker, args=(poll_interval,), daemon=True) for i in range(workers)]
+    for process in processes:
+        process.start()
+    print(str(workers) + ' job workers started')
+
+    # Stop the workers along with this process
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                deleted = purge_jobs(max_age)
+                if deleted:
+                    print(str(deleted) + ' finished jobs deleted')
+            finally:
+                db.session.remove()
+            multiprocessing.connection.wait([process.sentinel for process in processes if process.is_alive()],
+                                            timeout=purge_interval)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+@app.cli.command('issue-certificates')
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--prefix', default='', help='Only the users whose username starts with it')
+@click.option('--user', 'usernames', multiple=True, help='Only this user, can be repeated')
+@click.option('--processes', type=int, default=None, help='Processes generating the certificates, CERTIFICATE_PROCESSES by default')
+def issue_certificates_command(output, prefix, usernames, processes):
+    """
+    Generates the certificates of all users who completed the course, or of the chosen
+    ones, into a zip file or, if OUTPUT ends with .pdf, a single pdf file. Run it with
+    `flask --app app issue-certificates certificados.zip`.
+    """
+    users = completed_users(prefix, usernames)
+    db.session.remove()
+
+    start = time.perf_counter()
+    files = issue_certificates([(full_name, certificate_code) for username, full_name, certificate_code in users],
+                               processes or app.config.get('CERTIFICATE_PROCESSES', 2))
+    if output.endswith('.pdf'):
+        with merged_pdf(files) as file, open(output, 'wb') as destination:
+            shutil.copyfileobj(file, destination)
+    else:
+        with open(output, 'wb') as destination:
+            for chunk in zip_stream((certificates_filename(username), file)
+                                    for (username, _, _), file in zip(users, files)):
+                destination.write(chunk)
+    duration = time.perf_counter() - start
+    print('{} certificates in {:.1f}s, {:.1f} certificates/s'.format(len(users), duration,
+                                                                    len(users) / duration if duration else 0))
+
+
+@app.cli.command('send-emails')
+@click.option('--interval', type=float, default=None, help='Seconds between sendings')
+@click.option('--once', is_flag=True, help='Send the queued emails and exit')
+def send_emails(interval, once):
+    """
+    Sends the emails queued for the coordinators every EMAIL_INTERVAL seconds, keeping a
+    single connection to the SMTP server open between sendings. Run it with
+    `flask --app app send-emails`.
+    """
+    interval = interval if interval is not None else app.config.get('EMAIL_INTERVAL', 60)
+    connection = None
+
+    def smtp():
+        nonlocal connection
+        connection = smtp_connection(connection)
+        return connection
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            # The links to the tool are built outside of any request
+            with app.test_request_context(base_url=app.config.get('BASE_URL', 'https://ijc.toolforge.org')):
+                try:
+                    sent = send_outbox(smtp)
+                    if sent:
+                        print(str(sent) + ' emails sent')
+                except (smtplib.SMTPException, OSError) as error:
+                    app.logger.warning('Could not send the emails: %s', error)
+                    if connection is not None:
+                        connection.close()
+                    connection = None
+                finally:
+                    db.session.remove()
+            if once:
+                break
+            time.sleep(interval)
+    finally:
+        if connection is not None:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+
+@app.cli.command('poll-activities')
+@click.option('--interval', type=float, default=None, help='Seconds between polls, ACTIVITIES_POLL_INTERVAL by default')
+@click.option('--once', is_flag=True, help='Poll once and exit')
+def poll_activities(interval, once):
+    """
+    Reads the recent changes of Wikiversity every ACTIVITIES_POLL_INTERVAL seconds and
+    marks the activities whose pages were edited as submitted. Run it with
+    `flask --app app poll-activities`.
+    """
+    interval = interval if interval is not None else app.config.get('ACTIVITIES_POLL_INTERVAL', 300)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    while True:
+        try:
+            updated = poll_recent_changes()
+            if updated:
+                print(str(updated) + ' activities updated')
+        except (requests.RequestException, ValueError, KeyError) as error:
+            app.logger.warning('Could not read the recent changes: %s', error)
+        finally:
+            db.session.remove()
+        if once:
+            break
+        time.sleep(interval)
+
+
+@app.cli.command('migrate-activities-revisions')
+def migrate_activities_revisions():
+    """
+    Adds the column with the latest revision of the activities, the counter of the
+    submitted modules of the users and the table of the checkpoints to an existing
+    database, and counts the modules again. Run it once with
+    `flask --app app migrate-activities-revisions`, after `backfill-modules-counters`.
+    """
+    Checkpoint.__table__.create(db.engine, checkfirst=True)
+    columns = [column['name'] for column in db.inspect(db.engine).get_columns('module_status')]
+    users_columns = [column['name'] for column in db.inspect(db.engine).get_columns('users')]
+    with db.engine.begin() as connection:
+        if 'revid' not in columns:
+            connection.execute(db.text('ALTER TABLE module_status ADD COLUMN revid INTEGER'))
+        if 'submitted_modules' not in users_columns:
+            connection.execute(db.text('ALTER TABLE users ADD COLUMN submitted_modules INTEGER NOT NULL DEFAULT 0'))
+
+    update_modules_counters()
+    db.session.commit()
+    print('Database updated')
+
+
+@app.cli.command('backfill-validation-codes')
+def backfill_validation_codes():
+    """
+    Adds the indexed validation code columns to an existing database and fills them for
+    every registered user. Run it once with `flask --app app backfill-validation-codes`.
+    """
+    columns = [column['name'] for column in db.inspect(db.engine).get_columns('users')]
+    with db.engine.begin() as connection:
+        for column in ('subscription_code', 'certificate_code'):
+            if column not in columns:
+                connection.execute(db.text('ALTER TABLE users ADD COLUMN ' + column + ' VARCHAR(40)'))
+            connection.execute(db.text('CREATE INDEX IF NOT EXISTS ix_users_' + column + ' ON users (' + column + ')'))
+
+    users = db.session.execute(db.select(Users.id, Users.username, Users.date_modified)).all()
+    db.session.execute(db.update(Users), [
+        {'id': user.id,
+         'subscription_code': validation_code("Subscription", user.username, user.date_modified),
+         'certificate_code': validation_code("Certificate", user.username, user.date_modified)}
+        for user in users])
+    db.session.commit()
+    print(str(len(users)) + ' users updated')
+
+
+@app.cli.command('backfill-modules-counters')
+def backfill_modules_counters():
+    """
+    Adds the columns with the number of modules in each status and the indexed completion
+    flag to an existing database and fills them for every registered user. Run it once with
+    `flask --app app backfill-modules-counters`, after `migrate-module-status`.
+    """
+    columns = [column['name'] for column in db.inspect(db.engine).get_columns('users')]
+    with db.engine.begin() as connection:
+        for column in ('approved_modules', 'denied_modules', 'not_presented_modules', 'submitted_modules'):
+            if column not in columns:
+                connection.execute(db.text('ALTER TABLE users ADD COLUMN ' + column + ' INTEGER NOT NULL DEFAULT 0'))
+        if 'completed' not in columns:
+            connection.execute(db.text('ALTER TABLE users ADD COLUMN completed BOOLEAN NOT NULL DEFAULT 0'))
+        connection.execute(db.text('CREATE INDEX IF NOT EXISTS ix_users_completed ON users (completed)'))
+        connection.execute(db.text('CREATE INDEX IF NOT EXISTS ix_users_solicited_certificate_completed '
+                                   'ON users (solicited_certificate, completed)'))
+
+    update_modules_counters()
+    db.session.commit()
+    print(str(db.session.query(db.func.count(Users.id)).scalar()) + ' users updated')
+
+
+@app.cli.command('migrate-module-status')
+def migrate_module_status():
+    """
+    Moves the modules activities status of every user from the old semicolon separated
+    can_download_certificate column of the users table into the module_status table, and
+    drops the old column. Run it once with `flask --app app migrate-module-status`.
+    """
+    ModuleStatus.__table__.create(db.engine, checkfirst=True)
+    columns = [column['name'] for column in db.inspect(db.engine).get_columns('users')]
+    if 'can_download_certificate' not in columns:
+        print('Nothing to migrate')
+        return
+
+    with db.engine.begin() as connection:
+        users = connection.execute(db.text('SELECT id, can_download_certificate FROM users')).all()
+        now = datetime.utcnow()
+        modules_activities = [{'user_id': user.id, 'module': i + 1, 'status': module_status, 'updated_at': now}
+                              for user in users
+                              for i, module_status in enumerate(user.can_download_certificate.split(';'))]
+        if modules_activities:
+            connection.execute(db.insert(ModuleStatus).prefix_with('OR IGNORE'), modules_activities)
+        connection.execute(db.text('ALTER TABLE users DROP COLUMN can_download_certificate'))
+    print(str(len(users)) + ' users migrated')
 
 
 if __name__ == '__main__':
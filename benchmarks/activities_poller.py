@@ -0,0 +1,102 @@
+"""
+Runs the poller of the recent changes of Wikiversity against a local stub of the action
+API, and checks that only the changes made after the checkpoint are read.
+
+The stub keeps a feed of synthetic edits: some to the activity pages of the seeded
+students, the others to unrelated pages. The poller reads the whole feed once, then more
+edits are added and it polls again, and every activity edited must end as submitted with
+its latest revid, while each poll must only ask the API for the new changes.
+
+    python benchmarks/activities_poller.py --users 200 --edits 5000
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+from common import temporary_environment, synthetic_users, seed, start_stub, stub_url
+
+
+class RecentChanges:
+    """
+    The feed of the stub, ordered by rcid, with a few changes made in the same second
+    """
+    def __init__(self, titles, generator):
+        self.titles = titles
+        self.generator = generator
+        self.changes = []
+        self.time = datetime(2026, 1, 1)
+        self.served = 0
+
+    def edit(self, number_of_edits):
+        for _ in range(number_of_edits):
+            if self.generator.random() < 0.7:
+                self.time += timedelta(seconds=1)
+            rcid = len(self.changes) + 1
+            self.changes.append({'rcid': rcid, 'revid': 1000 + rcid, 'title': self.generator.choice(self.titles),
+                                 'timestamp': self.time.strftime('%Y-%m-%dT%H:%M:%SZ')})
+
+    def respond(self, path, params):
+        start = params.get('rcstart', [''])[0]
+        offset = int(params.get('rccontinue', ['0'])[0])
+        limit = int(params['rclimit'][0])
+        changes = [change for change in self.changes if change['timestamp'] >= start][offset:offset + limit]
+        self.served += len(changes)
+        data = {'query': {'recentchanges': changes}}
+        if len(changes) == limit:
+            data['continue'] = {'rccontinue': str(offset + limit), 'continue': '-||'}
+        return 'application/json', json.dumps(data).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='Students in the database')
+    parser.add_argument('--edits', type=int, default=5000, help='Changes in the feed before the first poll')
+    parser.add_argument('--new-edits', type=int, default=500, help='Changes added before the second poll')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random edits')
+    args = parser.parse_args()
+
+    temporary_environment()
+    generator = random.Random(args.seed)
+    users = synthetic_users(args.users, username='Estudante {}')
+    feed = RecentChanges([], generator)
+    stub = start_stub(feed.respond)
+    os.environ['FLASK_WIKIVERSITY_URL'] = stub_url(stub)
+    import app
+
+    feed.titles = [title.replace('_', ' ') + user['username'] for title in app.MODULES_ACTIVITIES_TITLES for user in users]
+    feed.titles += ['Página sem relação ' + str(i) for i in range(len(feed.titles))]
+    seed(app, users, 'NP')
+
+    failures = 0
+    print('{:<8} {:>10} {:>10} {:>18}'.format('poll', 'changes', 'read', 'activities updated'))
+    for poll, edits in (('first', args.edits), ('second', args.new_edits), ('idle', 0)):
+        feed.edit(edits)
+        served = feed.served
+        with app.app.app_context():
+            updated = app.poll_recent_changes()
+        # The changes made in the same second as the checkpoint are read again and skipped
+        read = feed.served - served
+        print('{:<8} {:>10} {:>10} {:>18}'.format(poll, edits, read, updated))
+        if read > edits + 10:
+            failures += 1
+
+    expected = {}
+    for change in feed.changes:
+        activity = app.activity_of_page(change['title'])
+        if activity:
+            expected[activity] = change['revid']
+    with app.app.app_context():
+        found = {(username, module): (status, revid) for username, module, status, revid in app.db.session.query(
+            app.Users.username, app.ModuleStatus.module, app.ModuleStatus.status, app.ModuleStatus.revid)
+            .join(app.Users.modules)}
+    wrong = [activity for activity, (status, revid) in found.items()
+             if (status, revid) != (('S', expected[activity]) if activity in expected else ('NP', None))]
+    print('{} activities submitted, {} wrong'.format(len(expected), len(wrong)))
+    if failures or wrong:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
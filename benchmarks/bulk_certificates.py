@@ -0,0 +1,83 @@
+"""
+Measures the certificates generated per second when issuing the certificates of a whole
+cohort, one document after the other in a single process and with pools of processes,
+into a zip file and into a single merged pdf file.
+
+The users are seeded in a temporary database and the documents cache starts empty, so
+every certificate is generated. Each case runs in its own process, so none starts with
+the fonts parsed by another.
+
+    python benchmarks/bulk_certificates.py --users 200 --processes 1 2 4
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import subprocess
+from common import temporary_directory, environment, synthetic_users, seed
+
+
+def run_case(output, processes):
+    import app
+
+    with app.app.app_context():
+        users = app.completed_users()
+    start = time.perf_counter()
+    files = app.issue_certificates([(full_name, code) for username, full_name, code in users], processes)
+    if output.endswith('.pdf'):
+        with app.merged_pdf(files) as file, open(output, 'wb') as destination:
+            shutil.copyfileobj(file, destination)
+        documents = app.PdfFileReader(output).getNumPages()
+    else:
+        with open(output, 'wb') as destination:
+            for chunk in app.zip_stream((app.certificates_filename(username), file)
+                                        for (username, _, _), file in zip(users, files)):
+                destination.write(chunk)
+        with zipfile.ZipFile(output) as archive:
+            documents = len(archive.namelist())
+    duration = time.perf_counter() - start
+    return {'certificates': len(users), 'documents': documents, 'seconds': duration,
+            'size': os.path.getsize(output)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='Users who completed the course')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4], help='Sizes of the pools compared')
+    parser.add_argument('--case', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--seed', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        import app
+        seed(app, synthetic_users(args.users, full_name='Estudante Sintético com um Nome Bastante Comprido Número {}'),
+             'T')
+        return
+    if args.case:
+        print(json.dumps(run_case(args.case[0], int(args.case[1]))))
+        return
+
+    directory = temporary_directory()
+    env = dict(os.environ, **environment(directory))
+    subprocess.run([sys.executable, __file__, '--seed', '--users', str(args.users)], env=env, check=True)
+
+    print('{:<8} {:>10} {:>14} {:>12} {:>12}'.format('output', 'processes', 'certificates/s', 'documents', 'size (MB)'))
+    failed = False
+    for extension in ('zip', 'pdf'):
+        for processes in args.processes:
+            output = os.path.join(directory, 'certificados.' + extension)
+            result = json.loads(subprocess.run([sys.executable, __file__, '--case', output, str(processes)], env=env,
+                                               check=True, capture_output=True, text=True).stdout.strip().splitlines()[-1])
+            print('{:<8} {:>10} {:>14.1f} {:>12} {:>12.1f}'.format(
+                extension, processes, result['certificates'] / result['seconds'], result['documents'],
+                result['size'] / 2 ** 20))
+            failed = failed or result['documents'] != result['certificates']
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
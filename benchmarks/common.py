@@ -0,0 +1,150 @@
+"""
+Shared by the benchmarks: a temporary directory for the database and the caches of the
+app, synthetic users to seed it with, a local stub of the Wikiversity APIs and synthetic
+pdf files.
+
+The app is pointed to the temporary directory through FLASK_ environment variables, set
+before it is imported, so the configured users.db is never touched. The app still reads
+its config.yaml, so one must be present to run any benchmark.
+"""
+import os
+import sys
+import json
+import atexit
+import shutil
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def environment(directory, database='users.db'):
+    """
+    :param directory: the directory of the database and the caches
+    :param database: the name of the database file
+    :return: the FLASK_ environment variables that point the database and the caches of the app to the directory
+    """
+    return {'FLASK_SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, database),
+            'FLASK_SQLALCHEMY_BINDS': json.dumps({'activities': 'sqlite:///' + os.path.join(directory, database)}),
+            'FLASK_PDF_CACHE_DIR': os.path.join(directory, 'pdf_cache'),
+            'FLASK_WIKIVERSITY_PDF_CACHE_DIR': os.path.join(directory, 'wikiversity_pdf_cache'),
+            'FLASK_ACTIVITY_CACHE_DIR': os.path.join(directory, 'activity_cache')}
+
+
+def temporary_directory():
+    """
+    :return: a new directory, removed when the process exits
+    """
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    return directory
+
+
+def temporary_environment():
+    """
+    Points the database and the caches of the app to a new temporary directory, for this
+    process and the ones it starts. It must be called before the app is imported.
+
+    :return: the directory
+    """
+    directory = temporary_directory()
+    os.environ.update(environment(directory))
+    return directory
+
+
+def synthetic_users(number_of_users, username='Estudante_{}', full_name='Estudante Sintético Número {}'):
+    """
+    :param number_of_users: the number of users
+    :param username: the format of the usernames, given the id of the user
+    :param full_name: the format of the full names, given the id of the user
+    :return: the columns of the users, with ids from 1
+    """
+    return [{'id': i, 'username': username.format(i), 'full_name': full_name.format(i)}
+            for i in range(1, number_of_users + 1)]
+
+
+def seed(app, users, statuses):
+    """
+    Creates the tables and inserts the users with the status of their modules, their
+    modules counters and their validation codes
+
+    :param app: the app module
+    :param users: the columns of the users, with at least the id and the username
+    :param statuses: the status of every module of every user, or a list with the statuses
+    of the modules of each user
+    """
+    from sqlalchemy import insert
+
+    date_modified = app.datetime.utcnow()
+    modules = app.app.config['NUMBER_OF_MODULES']
+    if isinstance(statuses, str):
+        statuses = [[statuses] * modules] * len(users)
+
+    rows = []
+    for user in users:
+        user = dict(user)
+        user.setdefault('date_modified', date_modified)
+        user.setdefault('subscription_code', app.validation_code("Subscription", user['username'], user['date_modified']))
+        user.setdefault('certificate_code', app.validation_code("Certificate", user['username'], user['date_modified']))
+        rows.append(user)
+
+    with app.app.app_context():
+        app.db.create_all()
+        app.db.session.execute(insert(app.Users), rows)
+        app.db.session.execute(insert(app.ModuleStatus), [
+            {'user_id': user['id'], 'module': module, 'status': status}
+            for user, user_statuses in zip(users, statuses) for module, status in enumerate(user_statuses, 1)])
+        app.update_modules_counters()
+        app.db.session.commit()
+
+
+def start_stub(respond):
+    """
+    Serves GET requests on a local port, from a thread
+
+    :param respond: a function of the path and the query parameters of a request, that
+    returns the content type and the body of the response
+    :return: the server
+    """
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            content_type, body = respond(url.path, parse_qs(url.query))
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stub_url(server):
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def synthetic_pdf(pages, label='Atividade', compress=True):
+    """
+    :param pages: the number of pages, each filled with text
+    :param label: the text repeated in the pages
+    :param compress: whether the pages are compressed
+    :return: the pdf file, as bytes
+    """
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_compression(compress)
+    pdf.set_font('Times', '', 9)
+    for page in range(pages):
+        pdf.add_page()
+        for line in range(60):
+            pdf.cell(w=0, h=4, ln=1, txt='{} {} {} '.format(label, page, line) * 12)
+    return pdf.output(dest='S').encode('latin-1')
@@ -0,0 +1,102 @@
+"""
+Measures the per-request cost of the users queries behind /validate and /certificate
+against a seeded SQLite database, with the encrypted full name loaded eagerly (before)
+and deferred (after).
+
+The benchmark database is a temporary file and the configured users.db is never touched.
+
+    python benchmarks/full_name_deferral.py --users 50000
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, insert, or_
+from sqlalchemy.orm import Session, undefer
+from app import db, Users, validation_code
+
+
+def seed(engine, number_of_users):
+    db.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.execute(insert(Users), [
+            {'username': 'Estudante_' + str(i),
+             'full_name': 'Estudante Sintético Número ' + str(i),
+             'date_modified': Users.date_modified.default.arg,
+             'subscription_code': validation_code("Subscription", 'Estudante_' + str(i), Users.date_modified.default.arg),
+             'certificate_code': validation_code("Certificate", 'Estudante_' + str(i), Users.date_modified.default.arg)}
+            for i in range(number_of_users)])
+        session.commit()
+
+
+def validate_eager(session, code):
+    users = session.query(Users).options(undefer(Users.full_name)).all()
+    hashs_sub = [hashlib.sha1(bytes("Subscription " + user.username + str(user.date_modified), 'utf-8')).hexdigest()
+                 for user in users]
+    hashs_certificate = [hashlib.sha1(bytes("Certificate " + user.username + str(user.date_modified), 'utf-8')).hexdigest()
+                         for user in users]
+    return code in hashs_sub or code in hashs_certificate
+
+
+def validate_deferred(session, code):
+    users = session.query(Users).all()
+    hashs_sub = [hashlib.sha1(bytes("Subscription " + user.username + str(user.date_modified), 'utf-8')).hexdigest()
+                 for user in users]
+    hashs_certificate = [hashlib.sha1(bytes("Certificate " + user.username + str(user.date_modified), 'utf-8')).hexdigest()
+                         for user in users]
+    return code in hashs_sub or code in hashs_certificate
+
+
+def validate_indexed(session, code):
+    return session.query(Users.id).filter(or_(Users.subscription_code == code,
+                                              Users.certificate_code == code)).first() is not None
+
+
+def list_eager(session, code):
+    return [(user.username, user.solicited_certificate)
+            for user in session.query(Users).options(undefer(Users.full_name)).all()]
+
+
+def list_deferred(session, code):
+    return [(user.username, user.solicited_certificate) for user in session.query(Users).all()]
+
+
+def measure(engine, function, code, repeat):
+    timings = []
+    for _ in range(repeat):
+        # A fresh session per run, as each request gets its own
+        with Session(engine) as session:
+            start = time.perf_counter()
+            function(session, code)
+            timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'users.db'))
+        seed(engine, args.users)
+        code = validation_code("Certificate", 'Estudante_' + str(args.users - 1), Users.date_modified.default.arg)
+
+        print('{} users, best of {} runs'.format(args.users, args.repeat))
+        for name, function in [('validate, full name loaded (before)', validate_eager),
+                               ('validate, full name deferred', validate_deferred),
+                               ('validate, indexed lookup (after)', validate_indexed),
+                               ('listing, full name loaded (before)', list_eager),
+                               ('listing, full name deferred (after)', list_deferred)]:
+            print('{:<40} {:>10.2f} ms'.format(name, 1000 * measure(engine, function, code, args.repeat)))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
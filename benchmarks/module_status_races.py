@@ -0,0 +1,132 @@
+"""
+Checks that no module status update is lost when coordinators and students act on the same
+users at the same time.
+
+Many threads approve the modules of the same students through /approve_certification,
+each thread a different module, and every approval must be in the database at the end.
+The same approvals are also made the way they used to be, reading the semicolon separated
+status string of the student, changing one module and writing the whole string back, to
+show the updates that approach loses. Then several threads request the certificate of the
+same student through /solicit_certificate at once, and a single email must be queued.
+
+    python benchmarks/module_status_races.py --users 50 --threads 12
+"""
+import sys
+import time
+import random
+import argparse
+import threading
+from common import temporary_environment, synthetic_users, seed
+
+
+def seed_legacy_users(app, number_of_users):
+    modules = app.app.config['NUMBER_OF_MODULES']
+    with app.app.app_context():
+        app.db.session.execute(app.db.text('CREATE TABLE legacy_users (id INTEGER PRIMARY KEY, '
+                                           'can_download_certificate VARCHAR)'))
+        app.db.session.execute(app.db.text('INSERT INTO legacy_users VALUES (:id, :status)'),
+                               [{'id': i, 'status': ';'.join(['F'] * modules)} for i in range(1, number_of_users + 1)])
+        app.db.session.commit()
+
+
+def legacy_approve(app, user_id, module):
+    # The read-modify-write of the status string done by the views before the module_status table
+    status = app.db.session.execute(app.db.text('SELECT can_download_certificate FROM legacy_users WHERE id = :id'),
+                                    {'id': user_id}).scalar().split(';')
+    status[module - 1] = 'T'
+    time.sleep(0)  # the rest of the request, letting other threads run
+    app.db.session.execute(app.db.text('UPDATE legacy_users SET can_download_certificate = :status WHERE id = :id'),
+                           {'id': user_id, 'status': ';'.join(status)})
+    app.db.session.commit()
+
+
+def run_in_threads(number_of_threads, tasks, work):
+    """
+    Splits the tasks between the threads, started together
+    """
+    barrier = threading.Barrier(number_of_threads)
+    errors = []
+
+    def thread(thread_tasks):
+        barrier.wait()
+        for task in thread_tasks:
+            try:
+                work(*task)
+            except Exception as error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=thread, args=(tasks[i::number_of_threads],)) for i in range(number_of_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help='Students whose modules are approved')
+    parser.add_argument('--threads', type=int, default=12, help='Simultaneous coordinators or requests')
+    args = parser.parse_args()
+
+    temporary_environment()
+    import app
+
+    seed(app, synthetic_users(args.users), 'F')
+    seed_legacy_users(app, args.users)
+    modules = app.app.config['NUMBER_OF_MODULES']
+    coordinator = app.app.config['COORDINATORS_USERNAMES'][0]
+    serializer = app.app.session_interface.get_signing_serializer(app.app)
+    clients = threading.local()
+
+    def request_as(username, path):
+        if not hasattr(clients, 'client'):
+            clients.client = app.app.test_client()
+        clients.client.set_cookie(app.app.config['SESSION_COOKIE_NAME'], serializer.dumps(
+            {'owner_key': 'benchmark', 'owner_secret': 'benchmark', 'username': username,
+             'username_checked_at': time.time()}))
+        response = clients.client.get(path)
+        if response.status_code != 302:
+            raise RuntimeError(path + ' answered ' + response.get_data(as_text=True))
+
+    def legacy(user_id, module):
+        with app.app.app_context():
+            legacy_approve(app, user_id, module)
+
+    # Ordered by user, so the threads approve different modules of the same students at the same time
+    approvals = [(user_id, module) for user_id in range(1, args.users + 1) for module in range(1, modules + 1)]
+
+    errors = run_in_threads(args.threads, approvals, lambda user_id, module: request_as(
+        coordinator, '/approve_certification/Estudante_{}/{}'.format(user_id, module)))
+    legacy_errors = run_in_threads(args.threads, approvals, legacy)
+
+    with app.app.app_context():
+        approved = app.db.session.query(app.db.func.count()).filter(app.ModuleStatus.status == "T").scalar()
+        legacy_approved = sum(status.count('T') for status in app.db.session.execute(
+            app.db.text('SELECT can_download_certificate FROM legacy_users')).scalars())
+
+        # Students with all modules but the last approved, so that they can request the certificate
+        app.db.session.execute(app.db.update(app.ModuleStatus).where(app.ModuleStatus.module == modules)
+                               .values(status="F"))
+        app.update_modules_counters()
+        app.db.session.commit()
+
+    students = random.sample(range(1, args.users + 1), min(10, args.users))
+    solicit_errors = run_in_threads(args.threads, [(student,) for student in students for _ in range(args.threads)],
+                                    lambda student: request_as('Estudante_' + str(student), '/solicit_certificate'))
+    with app.app.app_context():
+        emails = dict(app.db.session.query(app.OutboxEmail.username, app.db.func.count())
+                      .group_by(app.OutboxEmail.username))
+
+    print('{:<40} {:>10} {:>10} {:>8}'.format('', 'expected', 'found', 'errors'))
+    print('{:<40} {:>10} {:>10} {:>8}'.format('approvals, module_status updates', len(approvals), approved, len(errors)))
+    print('{:<40} {:>10} {:>10} {:>8}'.format('approvals, status string rewrites', len(approvals), legacy_approved,
+                                              len(legacy_errors)))
+    print('{:<40} {:>10} {:>10} {:>8}'.format('emails of simultaneous requests', len(students), sum(emails.values()),
+                                              len(solicit_errors)))
+    if approved != len(approvals) or sum(emails.values()) != len(students) or errors or solicit_errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
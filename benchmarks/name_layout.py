@@ -0,0 +1,104 @@
+"""
+Checks that fit_name lays out the names of the certificate exactly as they were laid out
+by measuring them on an FPDF document, and measures how long each takes.
+
+The names are synthetic Portuguese names of growing length, with prepositions, accented
+letters and characters the font doesn't cover, so that all the branches of the layout
+are taken: names that fit, abbreviated names and names whose font size is reduced.
+
+    python benchmarks/name_layout.py --names 2000
+"""
+import os
+import sys
+import math
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+FIRST_NAMES = ['Ana', 'João', 'Maria', 'José', 'Ângela', 'Luís', 'Conceição', 'Érica', 'Ênio', 'Íris', 'Zoë']
+SURNAMES = ['Silva', 'Santos', 'Oliveira', 'Gonçalves', 'Albuquerque', 'Magalhães', 'Assunção', 'Wojciechowski',
+            'Nascimento', 'Conceição', 'Brandão', 'Müller', 'Ngũgĩ', '王', 'Ἀριστοτέλης']
+PREPOSITIONS = ['da', 'de', 'do', 'dos', 'das', 'e']
+
+
+def synthetic_name(generator):
+    parts = [generator.choice(FIRST_NAMES)]
+    for _ in range(generator.randint(0, 12)):
+        if generator.random() < 0.3:
+            parts.append(generator.choice(PREPOSITIONS))
+        parts.append(generator.choice(SURNAMES))
+    return ' '.join(parts)
+
+
+def fpdf_fit_name(pdf, name):
+    """
+    The layout of the name as certificate_pdf did it before fit_name
+    """
+    size = 35
+    pdf.set_font('Merriweather', '', 35)
+    name_size = pdf.get_string_width(name)
+
+    if name_size > 287:
+        name_split = [name_part for name_part in name.split(' ') if not name_part.islower()]
+        if len(name_split) > 2:
+            first_name = name_split[0]
+            last_name = name_split[-1]
+            middle_names = [md_name[0]+'.' for md_name in name_split[1:-1]]
+            name = first_name + ' ' + ' '.join(middle_names) + ' ' + last_name
+            name_size = pdf.get_string_width(name)
+
+        if name_size > 287:
+            size = math.floor(287 * 35 / name_size)
+    return name, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--names', type=int, default=2000, help='Synthetic names laid out')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random names')
+    args = parser.parse_args()
+
+    import app
+
+    generator = random.Random(args.seed)
+    names = [synthetic_name(generator) for _ in range(args.names)]
+
+    start = time.perf_counter()
+    pdf = app.CertificationPDF(orientation='L', unit='mm', format='A4')
+    for family, fname in app.CERTIFICATE_FONTS.items():
+        pdf.add_font(family, '', os.path.join(app.app.static_folder, fname), uni=True)
+    fpdf_fonts = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = [fpdf_fit_name(pdf, name) for name in names]
+    fpdf_layout = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app.font_widths('Merriweather')
+    tables = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [app.fit_name(name) for name in names]
+    layout = time.perf_counter() - start
+    start = time.perf_counter()
+    for name in names:
+        app.fit_name(name)
+    memoized = time.perf_counter() - start
+
+    mismatches = [(name, a, b) for name, a, b in zip(names, expected, found) if a != b]
+    print('{} names: {} abbreviated, {} with a smaller font'.format(
+        len(names), sum(name != fitted for name, (fitted, size) in zip(names, expected)),
+        sum(size < 35 for fitted, size in expected)))
+    print('{:<32} {:>14} {:>14}'.format('', 'load (ms)', 'per name (µs)'))
+    print('{:<32} {:>14.1f} {:>14.1f}'.format('FPDF document', fpdf_fonts * 1000, fpdf_layout / len(names) * 1e6))
+    print('{:<32} {:>14.1f} {:>14.1f}'.format('glyph width tables', tables * 1000, layout / len(names) * 1e6))
+    print('{:<32} {:>14} {:>14.1f}'.format('glyph width tables, memoized', '', memoized / len(names) * 1e6))
+    print('{} mismatches'.format(len(mismatches)))
+    for name, a, b in mismatches[:10]:
+        print('  {!r}: {} != {}'.format(name, a, b))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Measures how many certificates and subscription letters are generated per second when
+every document parses the fonts and decodes the images again (before) and when they
+are parsed once per process and shared by the documents (after).
+
+The pt_BR locale used for the dates must be installed.
+
+    python benchmarks/pdf_generation.py --documents 50
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import CachedResourcesPDF, certificate_pdf, subscription_letter_pdf
+
+FULL_NAME = 'Maria Aparecida da Silva Pereira de Albuquerque Cavalcanti'
+VALIDATION_CODE = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+
+
+def certificate(i):
+    return certificate_pdf(FULL_NAME + ' ' + str(i), VALIDATION_CODE)
+
+
+def letter(i):
+    return subscription_letter_pdf('Estudante_' + str(i), FULL_NAME + ' ' + str(i), VALIDATION_CODE)
+
+
+def documents_per_second(function, documents, cached):
+    start = time.perf_counter()
+    for i in range(documents):
+        if not cached:
+            CachedResourcesPDF.cached_fonts.clear()
+            CachedResourcesPDF.cached_images.clear()
+        function(i)
+    return documents / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=50)
+    args = parser.parse_args()
+
+    # Warm up the resources once, so the cached runs don't pay for the first parse
+    certificate(0)
+    letter(0)
+
+    print('{} documents per run'.format(args.documents))
+    for name, function in [('certificate', certificate), ('subscription letter', letter)]:
+        before = documents_per_second(function, args.documents, cached=False)
+        after = documents_per_second(function, args.documents, cached=True)
+        print('{:<20} before {:>8.2f} PDFs/s   after {:>8.2f} PDFs/s   ({:.1f}x)'.format(name, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Measures the peak resident memory of serving the course program (/index) and the merged
+activities (/generate_attachment) fully buffered in memory (before) and streamed (after).
+
+Each case runs in its own process, so the peak RSS of one doesn't hide the others. The
+course program is served by a local HTTP server, and the activities are synthetic pdf
+files, so nothing is fetched from Wikiversity.
+
+    python benchmarks/pdf_streaming_memory.py --pages 400
+"""
+import io
+import os
+import sys
+import json
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from common import synthetic_pdf
+
+CASES = ['index_before', 'index_after', 'attachment_before', 'attachment_after']
+
+
+def peak_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_case(case, directory):
+    import requests
+    import app
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+
+    activities = []
+    for module in range(1, 7):
+        with open(os.path.join(directory, 'atividade_' + str(module) + '.pdf'), 'rb') as file:
+            activities.append(file.read())
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), lambda *args: QuietHandler(*args, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/programa.pdf'.format(server.server_address[1])
+
+    with app.app.test_request_context():
+        baseline = peak_rss()
+        sent = 0
+        if case == 'index_before':
+            sent = len(app.make_response(requests.get(url).content).get_data())
+        elif case == 'index_after':
+            upstream = requests.get(url, stream=True)
+            for chunk in app.Response(upstream.iter_content(64 * 1024)).response:
+                sent += len(chunk)
+        elif case == 'attachment_before':
+            responses = [PdfFileReader(io.BytesIO(activity)) for activity in activities]
+            output = io.BytesIO()
+            writer = PdfFileWriter()
+            for response in responses:
+                for i in range(response.getNumPages()):
+                    writer.addPage(response.getPage(i))
+            writer.write(output)
+            sent = len(app.Response(output.getvalue(), mimetype="application/pdf").get_data())
+        elif case == 'attachment_after':
+            app.fetch_wikiversity_pdfs = lambda titles: activities
+            file, failed_modules = app.attachment_pdf('Estudante')
+            for chunk in app.send_file(file, mimetype='application/pdf').response:
+                sent += len(chunk)
+    server.shutdown()
+    return {'case': case, 'bytes_sent': sent, 'peak_rss_increase': peak_rss() - baseline}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=400, help='Pages of each synthetic activity')
+    parser.add_argument('--case', choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.directory)))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The files are generated here, so that generating them doesn't count in the peaks
+        activities = [synthetic_pdf(args.pages, 'Atividade ' + str(module), compress=False) for module in range(1, 7)]
+        for module, activity in enumerate(activities, 1):
+            with open(os.path.join(directory, 'atividade_' + str(module) + '.pdf'), 'wb') as file:
+                file.write(activity)
+        with open(os.path.join(directory, 'programa.pdf'), 'wb') as file:
+            file.write(b''.join(activities))
+        del activities
+
+        print('{:<20} {:>12} {:>22}'.format('case', 'MB sent', 'peak RSS increase (MB)'))
+        for case in CASES:
+            output = subprocess.run([sys.executable, __file__, '--case', case, '--directory', directory],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print('{:<20} {:>12.1f} {:>22.1f}'.format(case, result['bytes_sent'] / 2 ** 20,
+                                                      result['peak_rss_increase'] / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+Measures the throughput, the latency percentiles and the peak resident memory of the routes
+of the tool against a database seeded with synthetic users, with the Wikiversity action API
+and the REST pdf renderer replaced by a local stub server.
+
+Each route runs in its own process, so the peak RSS of one doesn't hide the others. The
+requests are made with the Flask test client, or with --server to a WSGI server listening
+on a local port, against a temporary database and caches. The results are written as
+JSON, to be compared between runs.
+
+    python benchmarks/routes.py --users 5000 --requests 200 --concurrency 4 --output results.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import resource
+import threading
+import subprocess
+from common import temporary_environment, synthetic_users, seed, start_stub, stub_url, synthetic_pdf
+
+ROUTES = ['home', 'validate_document', 'certificate', 'coordinator_dashboard', 'subscription_letter',
+          'generate_certificate', 'generate_attachment', 'course_index']
+
+
+def seed_users(number_of_users, seed_value):
+    """
+    Creates the users with their modules in mixed states: about a quarter approved in all
+    modules, a quarter waiting for the coordinators and the rest with activities to be done.
+    """
+    import app
+
+    generator = random.Random(seed_value)
+    modules = app.app.config['NUMBER_OF_MODULES']
+    users = synthetic_users(number_of_users)
+    statuses = []
+    for user in users:
+        kind = generator.random()
+        if kind < 0.25:
+            statuses.append(['T'] * modules)
+        elif kind < 0.5:
+            statuses.append([generator.choice(['T', 'NP']) for _ in range(modules)])
+        else:
+            statuses.append([generator.choice(['T', 'F', 'NP']) for _ in range(modules)])
+        user['solicited_certificate'] = 0.25 <= kind < 0.5
+    seed(app, users, statuses)
+
+
+def stub_response(pdf):
+    """
+    :return: a function answering the revisions queries of the action API, always with
+    the same revision, and the same pdf file for any page of the REST renderer
+    """
+    def respond(path, params):
+        if path == '/w/api.php':
+            titles = params['titles'][0].split('|')
+            return 'application/json', json.dumps({'query': {'pages': [{'title': title, 'revisions': [{'revid': 1}]}
+                                                                       for title in titles]}}).encode()
+        return 'application/pdf', pdf
+    return respond
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, max(0, math.ceil(p / 100 * len(latencies)) - 1))]
+
+
+def peak_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def route_requests(route, app):
+    """
+    :return: the username to log in with and a function that makes the i-th request of
+    the route, as a (method, path, form) tuple, cycling over the seeded users
+    """
+    with app.app.app_context():
+        approved = [username for username, in app.db.session.query(app.Users.username)
+                    .filter(app.Users.completed.is_(True)).order_by(app.Users.id)]
+        codes = [code for code, in app.db.session.query(app.Users.certificate_code).order_by(app.Users.id).limit(1000)]
+    coordinator = app.app.config['COORDINATORS_USERNAMES'][0]
+
+    if route == 'home':
+        return lambda i: ('Estudante_1', 'GET', '/', None)
+    if route == 'validate_document':
+        return lambda i: (None, 'POST', '/validate', {'hash': codes[i % len(codes)] if i % 2 else 'invalido'})
+    if route == 'certificate':
+        return lambda i: ('Estudante_' + str(i % len(codes) + 1), 'GET', '/certificate', None)
+    if route == 'coordinator_dashboard':
+        return lambda i: (coordinator, 'GET', '/certificate?page=' + str(i % 10 + 1), None)
+    if route == 'subscription_letter':
+        return lambda i: ('Estudante_' + str(i % len(codes) + 1), 'GET', '/subscription_letter', None)
+    if route == 'generate_certificate':
+        return lambda i: (approved[i % len(approved)], 'GET', '/generate_certificate', None)
+    if route == 'generate_attachment':
+        return lambda i: (approved[i % len(approved)], 'GET', '/generate_attachment', None)
+    if route == 'course_index':
+        return lambda i: (None, 'GET', '/index', None)
+
+
+def run_route(route, number_of_requests, concurrency, use_server, pdf_path):
+    with open(pdf_path, 'rb') as file:
+        stub = start_stub(stub_response(file.read()))
+    os.environ['FLASK_WIKIVERSITY_URL'] = stub_url(stub)
+
+    import app
+    import requests
+    from werkzeug.serving import make_server
+
+    make_request = route_requests(route, app)
+    serializer = app.app.session_interface.get_signing_serializer(app.app)
+
+    def session_cookie(username):
+        if not username:
+            return ''
+        return serializer.dumps({'owner_key': 'benchmark', 'owner_secret': 'benchmark',
+                                 'username': username, 'username_checked_at': time.time()})
+
+    if use_server:
+        server = make_server('127.0.0.1', 0, app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    latencies = []
+    errors = []
+    counter = iter(range(number_of_requests))
+    lock = threading.Lock()
+
+    def worker():
+        http = requests.Session() if use_server else app.app.test_client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            username, method, path, form = make_request(i)
+            cookie = session_cookie(username)
+            start = time.perf_counter()
+            if use_server:
+                response = http.request(method, base_url + path, data=form,
+                                        cookies={app.app.config['SESSION_COOKIE_NAME']: cookie},
+                                        allow_redirects=False)
+                status = response.status_code
+            else:
+                http.set_cookie(app.app.config['SESSION_COOKIE_NAME'], cookie)
+                response = http.open(path, method=method, data=form)
+                response.get_data()
+                status = response.status_code
+                response.close()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status >= 500:
+                    errors.append(status)
+
+    baseline = peak_rss()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {'route': route,
+            'requests': len(latencies),
+            'errors': len(errors),
+            'concurrency': concurrency,
+            'server': use_server,
+            'throughput': len(latencies) / duration,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'peak_rss': peak_rss(),
+            'peak_rss_increase': peak_rss() - baseline}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000, help='Synthetic users in the database')
+    parser.add_argument('--requests', type=int, default=200, help='Requests made to each route')
+    parser.add_argument('--concurrency', type=int, default=4, help='Simultaneous clients')
+    parser.add_argument('--pages', type=int, default=20, help='Pages of the pdf files served by the stub')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('--server', action='store_true', help='Make the requests to a WSGI server on a local port')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random module states')
+    parser.add_argument('--output', default='benchmark_routes.json', help='Where the results are written')
+    parser.add_argument('--route', choices=ROUTES, help=argparse.SUPPRESS)
+    parser.add_argument('--pdf', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.route:
+        print(json.dumps(run_route(args.route, args.requests, args.concurrency, args.server, args.pdf)))
+        return
+
+    directory = temporary_environment()
+    seed_users(args.users, args.seed)
+    pdf_path = os.path.join(directory, 'atividade.pdf')
+    with open(pdf_path, 'wb') as file:
+        file.write(synthetic_pdf(args.pages))
+
+    results = []
+    print('{:<24} {:>10} {:>8} {:>8} {:>8} {:>8} {:>16}'.format(
+        'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'peak RSS (MB)'))
+    for route in args.routes:
+        command = [sys.executable, __file__, '--route', route, '--pdf', pdf_path,
+                   '--requests', str(args.requests), '--concurrency', str(args.concurrency)]
+        if args.server:
+            command.append('--server')
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print('{:<24} {:>10.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8} {:>16.1f}'.format(
+            route, result['throughput'], result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000,
+            result['errors'], result['peak_rss'] / 2 ** 20))
+
+    with open(args.output, 'w') as file:
+        json.dump({'users': args.users, 'requests': args.requests, 'concurrency': args.concurrency,
+                   'server': args.server, 'routes': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Stresses the database with coordinators approving activities from several processes at
+once, while other processes read the students table, and checks that no approval is lost.
+
+It runs twice against a temporary database: as the app did before, in rollback journal
+mode, failing at once on a locked database and without retrying the locked transactions
+(before), and with SQLITE_PRAGMAS and commit_or_retry (after). Each writer approves its
+own activities, one transaction each, so once all writers are done every activity that
+didn't fail must be approved, and in the after mode none may fail.
+
+    python benchmarks/sqlite_concurrency.py --writers 8 --readers 4 --decisions 2000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from common import temporary_directory, environment, synthetic_users, seed
+
+MODES = {'before': {'FLASK_SQLITE_PRAGMAS': json.dumps({'journal_mode': 'DELETE', 'busy_timeout': 0}),
+                    'FLASK_SQLITE_BUSY_RETRIES': '1'},
+         'after': {}}
+
+
+def writer(worker, writers, decisions):
+    """
+    Approves the activities numbered worker, worker + writers, worker + 2 * writers...
+    """
+    import app
+
+    modules = app.app.config['NUMBER_OF_MODULES']
+    approved = []
+    errors = 0
+    start = time.perf_counter()
+    with app.app.app_context():
+        for activity in range(worker, decisions, writers):
+            user_id, module = activity // modules + 1, activity % modules + 1
+            try:
+                app.commit_or_retry(lambda: app.update_modules_status(user_id, "T", module=module))
+                approved.append(activity)
+            except app.OperationalError:
+                errors += 1
+    return {'approved': approved, 'errors': errors, 'seconds': time.perf_counter() - start}
+
+
+def reader(seconds):
+    import app
+
+    reads = 0
+    errors = 0
+    deadline = time.time() + seconds
+    with app.app.app_context():
+        while time.time() < deadline:
+            try:
+                app.Users.query.order_by(app.Users.username).limit(50).all()
+                app.count_modules_status()
+                reads += 1
+            except app.OperationalError:
+                errors += 1
+            app.db.session.rollback()
+    return {'reads': reads, 'errors': errors}
+
+
+def run_mode(mode, directory, args):
+    env = dict(os.environ, **environment(directory, mode + '.db'), **MODES[mode])
+    subprocess.run([sys.executable, __file__, '--seed', str(args.users)], env=env, check=True)
+
+    processes = [subprocess.Popen([sys.executable, __file__, '--writer', str(worker), '--writers', str(args.writers),
+                                   '--decisions', str(args.decisions)], env=env, stdout=subprocess.PIPE, text=True)
+                 for worker in range(args.writers)]
+    processes += [subprocess.Popen([sys.executable, __file__, '--reader', str(args.read_seconds)],
+                                   env=env, stdout=subprocess.PIPE, text=True)
+                  for _ in range(args.readers)]
+    results = [json.loads(process.communicate()[0].strip().splitlines()[-1]) for process in processes]
+    duration = max(result['seconds'] for result in results[:args.writers])
+
+    approved = sum((result['approved'] for result in results[:args.writers]), [])
+    output = subprocess.run([sys.executable, __file__, '--count'], env=env, check=True, capture_output=True, text=True)
+    in_database = json.loads(output.stdout.strip().splitlines()[-1])
+    return {'mode': mode,
+            'writes_per_second': len(approved) / duration,
+            'write_errors': sum(result['errors'] for result in results[:args.writers]),
+            'reads': sum(result['reads'] for result in results[args.writers:]),
+            'read_errors': sum(result['errors'] for result in results[args.writers:]),
+            'lost_updates': len(set(approved) - set(in_database))}
+
+
+def approved_activities():
+    import app
+
+    modules = app.app.config['NUMBER_OF_MODULES']
+    with app.app.app_context():
+        return [(user_id - 1) * modules + module - 1 for user_id, module in app.db.session.query(
+            app.ModuleStatus.user_id, app.ModuleStatus.module).filter(app.ModuleStatus.status == "T")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=8, help='Processes approving activities')
+    parser.add_argument('--readers', type=int, default=4, help='Processes reading the students table')
+    parser.add_argument('--decisions', type=int, default=2000, help='Activities approved, in total')
+    parser.add_argument('--read-seconds', type=float, default=5, help='How long each reader keeps reading')
+    parser.add_argument('--users', type=int, default=1000, help='Users in the database')
+    parser.add_argument('--seed', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--writer', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--reader', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--count', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        import app
+        seed(app, synthetic_users(args.seed), 'NP')
+    elif args.writer is not None:
+        print(json.dumps(writer(args.writer, args.writers, args.decisions)))
+    elif args.reader is not None:
+        print(json.dumps(reader(args.reader)))
+    elif args.count:
+        print(json.dumps(approved_activities()))
+    else:
+        print('{:<8} {:>10} {:>14} {:>8} {:>12} {:>14}'.format(
+            'mode', 'writes/s', 'write errors', 'reads', 'read errors', 'lost updates'))
+        directory = temporary_directory()
+        failed = False
+        for mode in MODES:
+            result = run_mode(mode, directory, args)
+            print('{:<8} {:>10.1f} {:>14} {:>8} {:>12} {:>14}'.format(
+                mode, result['writes_per_second'], result['write_errors'], result['reads'],
+                result['read_errors'], result['lost_updates']))
+            if mode == 'after' and (result['write_errors'] or result['lost_updates']):
+                failed = True
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
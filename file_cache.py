@@ -0,0 +1,124 @@
+import os
+import glob
+import shutil
+import tempfile
+
+
+class FileCache:
+    """
+    A directory of files addressed by key, bounded in size. Reading a file marks it as
+    recently used, and the least recently used files are evicted once the directory
+    grows beyond its maximum size. Files are written atomically, so several workers
+    can share the same directory.
+    """
+
+    def __init__(self, directory, max_size, suffix=''):
+        self.directory = directory
+        self.max_size = max_size
+        self.suffix = suffix
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """
+        :param key: the key of the file
+        :return: the content of the file, or None if it isn't cached
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return content
+
+    def open(self, key):
+        """
+        :param key: the key of the file
+        :return: the file opened for reading, or None if it isn't cached
+        """
+        try:
+            file = open(self.path(key), 'rb')
+            os.utime(file.fileno())
+        except OSError:
+            return None
+        return file
+
+    def put(self, key, content):
+        """
+        Stores the content under the key, evicting the least recently used files if needed
+
+        :param key: the key of the file
+        :param content: the content to be stored, as bytes
+        """
+        for _ in self.put_stream(key, [content]):
+            pass
+
+    def put_file(self, key, file):
+        """
+        Stores the content of a file opened for reading under the key
+
+        :param key: the key of the file
+        :param file: the file, read from its current position
+        """
+        for _ in self.put_stream(key, iter(lambda: file.read(shutil.COPY_BUFSIZE), b'')):
+            pass
+
+    def put_stream(self, key, chunks):
+        """
+        Stores the chunks under the key while yielding them, so that a response can be sent
+        and cached at the same time. The file is only stored once all chunks were consumed.
+
+        :param key: the key of the file
+        :param chunks: an iterable of bytes
+        """
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    yield chunk
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        os.replace(temporary_path, self.path(key))
+        self.evict()
+
+    def discard(self, pattern):
+        """
+        Removes the files whose keys match a glob pattern
+
+        :param pattern: the glob pattern of the keys to be removed
+        """
+        for path in glob.glob(os.path.join(self.directory, pattern + self.suffix)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
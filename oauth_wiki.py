@@ -1,21 +1,64 @@
+import time
+import requests
+import threading
 from flask import current_app, session
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1Session
 from urllib.parse import urlencode
+from urllib3.util.retry import Retry
+from profiling import span
 
 
 project = 'https://pt.wikiversity.org/w/api.php?'
 
+_adapters = {}
+_adapter_lock = threading.Lock()
+
+
+def pooled_adapter(signed=False):
+    """
+    The transport shared by the sessions of the process, so that the connections to
+    Wikiversity are kept alive and reused instead of opened for each call. Throttled and
+    failed idempotent requests are retried with exponential backoff. A signed OAuth
+    request can't be sent again, as MediaWiki rejects its nonce the second time, so for
+    those only the connections that could not be opened are retried.
+
+    :param signed: whether the requests sent through it are signed
+    """
+    with _adapter_lock:
+        if signed not in _adapters:
+            app = current_app
+            if signed:
+                retries = Retry(total=app.config.get('HTTP_RETRIES', 3), connect=app.config.get('HTTP_RETRIES', 3),
+                                read=0, status=0, backoff_factor=app.config.get('HTTP_RETRY_BACKOFF', 0.5))
+            else:
+                retries = Retry(total=app.config.get('HTTP_RETRIES', 3),
+                                backoff_factor=app.config.get('HTTP_RETRY_BACKOFF', 0.5),
+                                status_forcelist=[429, 500, 502, 503, 504],
+                                raise_on_status=False)
+            _adapters[signed] = HTTPAdapter(pool_connections=app.config.get('HTTP_POOL_SIZE', 10),
+                                            pool_maxsize=app.config.get('HTTP_POOL_SIZE', 10),
+                                            max_retries=retries)
+    return _adapters[signed]
+
+
+def oauth_session(client_key, **kwargs):
+    oauth = OAuth1Session(client_key, **kwargs)
+    oauth.mount('https://', pooled_adapter(signed=True))
+    return oauth
+
 
 def raw_request(params):
     app = current_app
     url = project + urlencode(params)
     client_key = app.config['CONSUMER_KEY']
     client_secret = app.config['CONSUMER_SECRET']
-    oauth = OAuth1Session(client_key,
+    oauth = oauth_session(client_key,
                           client_secret=client_secret,
                           resource_owner_key=session['owner_key'],
                           resource_owner_secret=session['owner_secret'])
-    return oauth.get(url, timeout=4)
+    with span('api'):
+        return oauth.get(url, timeout=4)
 
 
 def api_request(params):
@@ -27,16 +70,44 @@ def userinfo_call():
     return api_request(params)
 
 
-def get_username():
-    if 'owner_key' not in session:
-        return  # not authorized
-
-    if 'username' in session:
-        return session['username']
+def resolve_username():
+    """
+    Asks Wikiversity whose are the tokens of the session. It is called at login and once
+    every USERNAME_MAX_AGE seconds, and the username is kept in the session with the time
+    it was checked.
 
+    :return: the username, None if the tokens are no longer valid
+    """
     reply = userinfo_call()
-    if 'query' not in reply:
+    if 'query' not in reply or 'anon' in reply['query']['userinfo']:
         return
     session['username'] = reply['query']['userinfo']['name']
+    session['username_checked_at'] = time.time()
+
+    return session['username']
+
+
+def forget_username():
+    for key in ('username', 'username_checked_at'):
+        session.pop(key, None)
+
+
+def get_username():
+    """
+    Reads the username cached in the session. Once it is older than USERNAME_MAX_AGE
+    seconds, or if the session predates the time of the check, it is resolved again with
+    the tokens of the session, and the user is logged out only if they were revoked.
+    """
+    if 'owner_key' not in session or 'username' not in session:
+        return  # not authorized
+
+    if time.time() - session.get('username_checked_at', 0) > current_app.config.get('USERNAME_MAX_AGE', 12 * 60 * 60):
+        try:
+            if not resolve_username():
+                forget_username()
+                return
+        except (requests.RequestException, ValueError) as error:
+            # Checked again on the next request
+            current_app.logger.warning('Could not check the username: %s', error)
 
     return session['username']
\ No newline at end of file
@@ -0,0 +1,85 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from flask import g, has_app_context
+
+
+@contextmanager
+def span(name):
+    """
+    Times the block and records it in the profile of the current request, if any
+
+    :param name: the name of the span, as shown in the Server-Timing header
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name, duration):
+    if has_app_context() and 'profiling' in g:
+        g.profiling.append((name, duration))
+
+
+def server_timing(spans, total):
+    """
+    :param spans: a list of (name, duration in seconds) tuples
+    :param total: the duration of the whole request, in seconds
+    :return: the value of a Server-Timing header, with the spans of the same name added up
+    """
+    durations = {}
+    counts = {}
+    for name, duration in spans:
+        durations[name] = durations.get(name, 0) + duration
+        counts[name] = counts.get(name, 0) + 1
+
+    metrics = ['%s;dur=%.2f;desc="%d"' % (name, durations[name] * 1000, counts[name]) for name in durations]
+    metrics.append('total;dur=%.2f' % (total * 1000))
+    return ', '.join(metrics)
+
+
+class Metrics:
+    """
+    The latency of each route, as Prometheus histograms, and the time spent in each kind of
+    span. Kept in memory, so each worker process exposes its own.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.spans = {}
+
+    def observe(self, route, duration, spans):
+        with self.lock:
+            counts, total = self.routes.get(route, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, duration)] += 1
+            self.routes[route] = counts, total + duration
+            for name, span_duration in spans:
+                count, span_total = self.spans.get(name, (0, 0))
+                self.spans[name] = count + 1, span_total + span_duration
+
+    def exposition(self):
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        lines = ['# HELP ijc_request_duration_seconds Time spent handling the requests, by route',
+                 '# TYPE ijc_request_duration_seconds histogram']
+        with self.lock:
+            for route, (counts, total) in sorted(self.routes.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('ijc_request_duration_seconds_bucket{route="%s",le="%s"} %d' % (route, bound, cumulative))
+                lines.append('ijc_request_duration_seconds_sum{route="%s"} %f' % (route, total))
+                lines.append('ijc_request_duration_seconds_count{route="%s"} %d' % (route, cumulative))
+
+            lines += ['# HELP ijc_span_duration_seconds Time spent in database queries, API calls and pdf generation',
+                      '# TYPE ijc_span_duration_seconds summary']
+            for name, (count, total) in sorted(self.spans.items()):
+                lines.append('ijc_span_duration_seconds_sum{span="%s"} %f' % (name, total))
+                lines.append('ijc_span_duration_seconds_count{span="%s"} %d' % (name, count))
+        return '\n'.join(lines) + '\n'